@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+
+"""benchmark.py -- local benchmark of the ConferenceApi endpoints
+
+Fills the App Engine testbed datastore/memcache/taskqueue stubs with
+synthetic conferences, sessions, speakers and profiles (with wishlists,
+registrations and follows), then calls every endpoint and reports, per
+endpoint, cold and warm latency, datastore/memcache/taskqueue RPCs and
+peak memory growth. Run it at several scales to see how endpoints behave
+as data grows:
+
+    python benchmark.py --sdk ~/google_appengine --scale small medium
+    python benchmark.py --sdk ~/google_appengine --scale small \\
+        --conferences 50 --only queryConferences getSessionsInWishlist
+
+--contention N [N ...] has N threads register for a new conference at
+once, for each N, and reports registrations per second, sold out
+registrations and transaction failures apart, and datastore commits.
+
+--timeline lists the API RPCs of one registration in the order they are
+issued and completed; an RPC issued before an earlier one is done
+overlaps it.
+
+--copy-plans times the compiled entity -> form copy plans against the
+hasattr/getattr reflection they replaced, over 10000 in-memory entities.
+
+--n-plus-one runs every endpoint against the data set and one with twice
+as much of everything, and exits non-zero if an endpoint's RPC count
+grows with the number of items it returns (a per-item get or query).
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import argparse
+import collections
+import datetime
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+# conferences, sessions per conference, speakers, profiles
+SCALES = collections.OrderedDict([
+    ('small', (20, 10, 20, 50)),
+    ('medium', (200, 20, 100, 500)),
+    ('large', (1000, 30, 300, 2000)),
+])
+WISHLIST = 10       # sessions per profile
+REGISTRATIONS = 5   # conferences per profile
+FOLLOWING = 10      # followed users per profile
+COPY_ENTITIES = 10000   # per --copy-plans case
+ORGANIZER = 'organizer@example.com'
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin', 'Sydney']
+TOPICS = ['Web', 'Mobile', 'Cloud', 'Data', 'Security', 'Games']
+TYPES = ['workshop', 'lecture', 'keynote', 'panel']
+
+RPC_SERVICES = ('datastore_v3', 'memcache', 'taskqueue')   # counted
+
+RPCS = collections.Counter()
+
+
+def _countRpc(service, call, request, response):
+    if service in RPC_SERVICES:
+        RPCS['%s.%s' % (service, call)] += 1
+
+
+class _Timeline(object):
+    """Records when each API RPC is issued and completed while started."""
+
+    def __init__(self):
+        self.start = None
+        self.events = []
+        self.pending = {}
+
+    def reset(self):
+        self.start = time.time()
+        self.events = []
+        self.pending = {}
+
+    def stop(self):
+        self.start = None
+
+    def issued(self, service, call, request, response):
+        if self.start is not None:
+            n = self.pending[id(request)] = len(self.events) + 1
+            self.events.append((self._ms(), n, 'issue', '%s.%s' % (service, call)))
+
+    def done(self, service, call, request, response):
+        if self.start is not None:
+            n = self.pending.pop(id(request), '?')
+            self.events.append((self._ms(), n, 'done', '%s.%s' % (service, call)))
+
+    def _ms(self):
+        return (time.time() - self.start) * 1000
+
+TIMELINE = _Timeline()
+
+
+def setUp(sdk):
+    """Put the SDK on sys.path and activate the testbed stubs."""
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(consistency_policy=
+        datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_urlfetch_stub()
+    bed.init_mail_stub()
+    bed.init_user_stub()
+    # sampled endpoint stats add a memcache RPC to random calls
+    import stats
+    stats.SAMPLE_RATE = 0
+    # hook keys are unique per list, so one unfiltered hook counts every
+    # service in RPC_SERVICES
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', _countRpc)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchmark-timeline', TIMELINE.issued)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'benchmark-timeline', TIMELINE.done)
+    return bed
+
+
+def api(email):
+    """Return a ConferenceApi signed in as email, as for a new request."""
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    from conference import ConferenceApi
+    ndb.get_context().clear_cache()
+    service = ConferenceApi()
+    service._user = users.User(email)
+    return service
+
+
+def generate(conferences, sessions, speakers, profiles,
+             wishlist=WISHLIST, registrations=REGISTRATIONS, following=FOLLOWING):
+    """Create the synthetic data set through the API; returns a dict of the
+    keys the endpoint calls pick from."""
+    from google.appengine.ext import ndb
+    from protorpc import message_types
+    import conference
+    import models
+    import search
+    import social
+
+    rnd = random.Random(0)
+    today = datetime.date.today()
+    # organizer profile supplies organizerDisplayName
+    api(ORGANIZER).getProfile(message_types.VoidMessage())
+    for i in range(speakers):
+        api(ORGANIZER).addSpeaker(models.SpeakerForm(
+            displayName='Speaker %d' % i, mainEmail='speaker%d@example.com' % i))
+
+    c_keys = []
+    for first in range(0, conferences, conference.MAX_IMPORT_SIZE):
+        forms = []
+        for i in range(first, min(first + conference.MAX_IMPORT_SIZE, conferences)):
+            start = today + datetime.timedelta(days=rnd.randint(-180, 180))
+            seats = rnd.choice([10, 100, 1000, profiles + 10])
+            forms.append(models.ConferenceForm(
+                name='Conference %d %s' % (i, rnd.choice(TOPICS)),
+                description='All about %s' % rnd.choice(TOPICS),
+                city=rnd.choice(CITIES),
+                topics=rnd.sample(TOPICS, 2),
+                startDate=str(start),
+                endDate=str(start + datetime.timedelta(days=2)),
+                # the first conference, the one n+1 runs pick, never sells out
+                maxAttendees=seats if i else profiles * 10))
+        result = api(ORGANIZER).importConferences(models.ConferenceForms(items=forms))
+        c_keys += [form.websafeConferenceKey for form in result.items]
+
+    s_keys = []
+    for wsck in c_keys:
+        forms = [models.SessionForm(
+                    sessionName='Session %d' % i,
+                    highlights=rnd.sample(TOPICS, 2),
+                    speaker='Speaker %d' % rnd.randrange(speakers),
+                    duration=rnd.choice([30, 60, 90]),
+                    typeOfSession=rnd.choice(TYPES),
+                    date=str(today + datetime.timedelta(days=rnd.randint(-3, 3))),
+                    startTime='%02d:00' % rnd.randint(8, 20))
+                 for i in range(sessions)]
+        result = api(ORGANIZER).importSessions(
+            conference.SESSION_IMPORT_REQUEST.combined_message_class(
+                websafeConferenceKey=wsck, items=forms))
+        s_keys += [form.websafeSessionKey for form in result.items]
+
+    # run the search index tasks inline
+    for key in c_keys + s_keys:
+        search.indexDocument(ndb.Key(urlsafe=key))
+
+    # (user, key) pairs, popped by the calls that undo them
+    registered, wishes, follows = [], [], []
+    users = ['user%d@example.com' % i for i in range(profiles)]
+    for email in users:
+        for wsck in rnd.sample(c_keys, min(registrations, len(c_keys))):
+            try:
+                api(email).registerForConference(
+                    conference.CONF_GET_REQUEST.combined_message_class(
+                        websafeConferenceKey=wsck))
+                registered.append((email, wsck))
+            except Exception:
+                pass    # sold out
+        for wssk in rnd.sample(s_keys, min(wishlist, len(s_keys))):
+            api(email).addSessionToWishlist(
+                conference.WISH_POST_REQUEST.combined_message_class(
+                    websafeSessionKey=wssk))
+            wishes.append((email, wssk))
+    for email in users:
+        for other in rnd.sample(users, min(following + 1, len(users))):
+            if other != email:
+                api(email).followUser(conference.FOLLOW_REQUEST.combined_message_class(
+                    userId=other))
+                follows.append((email, other))
+    # run the feed fan-out tasks inline
+    for email in users:
+        social.fanOut(email)
+
+    return {'conferences': c_keys, 'sessions': s_keys, 'users': users,
+            'registered': registered, 'wishes': wishes, 'follows': follows,
+            'rnd': rnd, 'fresh': iter(xrange(sys.maxint))}
+
+
+def calls():
+    """Return (endpoint name, call) pairs; call(data) makes one request."""
+    from protorpc import message_types
+    import conference
+    import models
+
+    void = message_types.VoidMessage
+    conf = lambda d: d['rnd'].choice(d['conferences'])
+    user = lambda d: d['rnd'].choice(d['users'])
+    fresh = lambda d: 'bench%d@example.com' % next(d['fresh'])
+    page = lambda d, size: d.get('pageSize') or size
+    CONF = conference.CONF_GET_REQUEST.combined_message_class
+    PAGE = conference.PAGE_GET_REQUEST.combined_message_class
+    SEARCH = conference.SEARCH_REQUEST.combined_message_class
+    WISH = conference.WISH_POST_REQUEST.combined_message_class
+    FOLLOW = conference.FOLLOW_REQUEST.combined_message_class
+    today = str(datetime.date.today())
+
+    def session(i):
+        return models.SessionForm(
+            sessionName='New %d' % i, highlights=['Web'], speaker='Speaker 0',
+            duration=60, typeOfSession='lecture', date=today,
+            startTime='10:00')
+
+    def createSession(d):
+        form = session(0)
+        form.websafeConferenceKey = conf(d)
+        return api(ORGANIZER).createSession(form)
+
+    def unregister(d):
+        email, wsck = d['registered'].pop()
+        return api(email).unregisterFromConference(
+            CONF(websafeConferenceKey=wsck))
+
+    def unwish(d):
+        email, wssk = d['wishes'].pop()
+        return api(email).delete_session_from_wishlist(
+            WISH(websafeSessionKey=wssk))
+
+    def unfollow(d):
+        email, other = d['follows'].pop()
+        return api(email).unfollowUser(FOLLOW(userId=other))
+
+    def query(d):
+        return models.ConferenceQueryForms(filters=[
+            models.ConferenceQueryForm(field='CITY', operator='EQ',
+                                       value=d['rnd'].choice(CITIES)),
+            models.ConferenceQueryForm(field='MAX_ATTENDEES', operator='GT',
+                                       value='50')], pageSize=page(d, 20))
+
+    def sessionQuery(d):
+        return models.SessionQueryForms(filters=[
+            models.SessionQueryForm(field='TYPE', operator='EQ',
+                                    value=d['rnd'].choice(TYPES)),
+            models.SessionQueryForm(field='DURATION', operator='LTEQ',
+                                    value='60')], pageSize=page(d, 20))
+
+    return [
+        ('createConference', lambda d: api(fresh(d)).createConference(
+            models.ConferenceForm(name='New', city='Paris', maxAttendees=100))),
+        ('importConferences', lambda d: api(ORGANIZER).importConferences(
+            models.ConferenceForms(items=[
+                models.ConferenceForm(name='Imported %d' % i, city='Paris',
+                                      maxAttendees=100)
+                for i in range(10)]))),
+        ('updateConference', lambda d: api(ORGANIZER).updateConference(
+            conference.CONF_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=conf(d), description='Updated'))),
+        ('getConference', lambda d: api(user(d)).getConference(
+            CONF(websafeConferenceKey=conf(d)))),
+        ('getConferencesCreated', lambda d: api(ORGANIZER).getConferencesCreated(void())),
+        ('queryConferences', lambda d: api(user(d)).queryConferences(query(d))),
+        ('searchConferences', lambda d: api(user(d)).searchConferences(
+            SEARCH(query=d['rnd'].choice(TOPICS), pageSize=page(d, 20)))),
+        ('createSession', createSession),
+        ('importSessions', lambda d: api(ORGANIZER).importSessions(
+            conference.SESSION_IMPORT_REQUEST.combined_message_class(
+                websafeConferenceKey=conf(d),
+                items=[session(i) for i in range(10)]))),
+        ('getConferenceSessions', lambda d: api(user(d)).getConferenceSessions(
+            CONF(websafeConferenceKey=conf(d)))),
+        ('getConferenceSessionsByType', lambda d: api(user(d)).getConferenceSessionsByType(
+            conference.SESSION_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=conf(d), typeOfSession=d['rnd'].choice(TYPES)))),
+        ('querySessions', lambda d: api(user(d)).querySessions(sessionQuery(d))),
+        ('searchSessions', lambda d: api(user(d)).searchSessions(
+            SEARCH(query=d['rnd'].choice(TOPICS), pageSize=page(d, 20)))),
+        ('getConferenceSessionsBySpeaker', lambda d: api(user(d)).getSessionsBySpeaker(
+            conference.SPEAKER_GET_REQUEST.combined_message_class(speaker='Speaker 0'))),
+        ('getSpeaker', lambda d: api(user(d)).getSpeaker(
+            models.SpeakerForm(displayName='Speaker 0'))),
+        ('addSpeaker', lambda d: api(ORGANIZER).addSpeaker(models.SpeakerForm(
+            displayName='New Speaker %d' % next(d['fresh']),
+            mainEmail='new@example.com'))),
+        ('getAllSpeakers', lambda d: api(user(d)).getAllSpeakers(
+            PAGE(pageSize=page(d, 50)))),
+        ('addSessionToWishlist', lambda d: api(fresh(d)).addSessionToWishlist(
+            WISH(websafeSessionKey=d['rnd'].choice(d['sessions'])))),
+        ('deleteSessionInWishlist', unwish),
+        ('getSessionsInWishlist', lambda d: api(user(d)).getSessionsInWishlist(PAGE())),
+        ('getProfile', lambda d: api(user(d)).getProfile(void())),
+        ('saveProfile', lambda d: api(user(d)).saveProfile(
+            models.ProfileMiniForm(displayName='Renamed'))),
+        ('followUser', lambda d: api(fresh(d)).followUser(
+            FOLLOW(userId=user(d)))),
+        ('unfollowUser', unfollow),
+        ('getSocialFeed', lambda d: api(user(d)).getSocialFeed(void())),
+        ('getAnnouncement', lambda d: api(user(d)).getAnnouncement(void())),
+        ('getFeaturedSpeaker', lambda d: api(user(d)).getFeaturedSpeaker(void())),
+        ('getConferenceFeaturedSpeaker', lambda d: api(user(d)).getConferenceFeaturedSpeaker(
+            CONF(websafeConferenceKey=conf(d)))),
+        ('getConferencesToAttend', lambda d: api(user(d)).getConferencesToAttend(void())),
+        ('getConferenceAttendees', lambda d: api(ORGANIZER).getConferenceAttendees(
+            conference.ATTENDEE_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=conf(d), pageSize=page(d, 50)))),
+        ('registerForConference', lambda d: api(fresh(d)).registerForConference(
+            CONF(websafeConferenceKey=conf(d)))),
+        ('unregisterFromConference', unregister),
+        ('getPastSessions', lambda d: api(user(d)).getPastSessions(
+            PAGE(pageSize=page(d, 20)))),
+        ('getSessionsToday', lambda d: api(user(d)).getSessionsToday(void())),
+        ('getSessionsByTypeTime', lambda d: api(user(d)).getSessionsByTypeTime(void())),
+        ('filterPlayground', lambda d: api(user(d)).filterPlayground(void())),
+    ]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(call, data, repeat):
+    """Run call repeat times, the first with memcache flushed; returns a
+    report row, or the error the endpoint raised."""
+    from google.appengine.api import memcache
+    memcache.flush_all()
+    times, rpcs = [], []
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in range(repeat):
+        RPCS.clear()
+        start = time.time()
+        try:
+            call(data)
+        except Exception as e:
+            return '%s: %s' % (type(e).__name__, e)
+        times.append((time.time() - start) * 1000)
+        rpcs.append(sum(RPCS.values()))
+    warm = times[1:] or times
+    return (times[0], _percentile(warm, 0.5), _percentile(warm, 0.95),
+            rpcs[0], rpcs[-1],
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+
+
+class _First(object):
+    """Stands in for data['rnd'] so both n+1 runs make the same calls."""
+    def choice(self, seq):
+        return seq[0]
+
+
+def _items(response):
+    """Number of items in a response's repeated message fields."""
+    return sum(len(getattr(response, field.name))
+               for field in response.all_fields()
+               if field.repeated and hasattr(field, 'message_type'))
+
+
+def rpcProfile(call, data):
+    """Run call once on a cold cache; returns (items returned, RPCs), not
+    counting query batch fetches, which grow with any result size."""
+    from google.appengine.api import memcache
+    memcache.flush_all()
+    RPCS.clear()
+    response = call(data)
+    rpcs = sum(n for rpc, n in RPCS.items() if rpc != 'datastore_v3.Next')
+    return _items(response), rpcs
+
+
+def nPlusOne(args, sizes):
+    """Profile each endpoint at two data sizes; returns the names of those
+    whose RPC count grew with their result size."""
+    profiles = []
+    for factor in (1, 2):
+        n, m, k, p = [x * factor for x in sizes]
+        bed = setUp(args.sdk)
+        import conference
+        try:
+            data = generate(n, m, k, p, WISHLIST * factor,
+                            REGISTRATIONS * factor, FOLLOWING * factor)
+            data['rnd'] = _First()
+            # one page holds every result, so item counts can grow
+            data['pageSize'] = conference.MAX_PAGE_SIZE
+            profile = {}
+            for name, call in calls():
+                if args.only and name not in args.only:
+                    continue
+                try:
+                    profile[name] = rpcProfile(call, data)
+                except Exception as e:
+                    profile[name] = '%s: %s' % (type(e).__name__, e)
+            profiles.append(profile)
+        finally:
+            bed.deactivate()
+
+    print '%-32s %13s %13s' % ('endpoint', 'items/rpc x1', 'items/rpc x2')
+    failed = []
+    for name in profiles[0]:
+        small, large = profiles[0][name], profiles[1].get(name)
+        if isinstance(small, str) or isinstance(large, str):
+            print '%-32s %s' % (name, small if isinstance(small, str) else large)
+            continue
+        grew = large[0] > small[0] and large[1] > small[1]
+        if grew:
+            failed.append(name)
+        print '%-32s %6d/%-6d %6d/%-6d%s' % (
+            name, small[0], small[1], large[0], large[1],
+            '  N+1' if grew else '')
+    return failed
+
+
+def contention(threads):
+    """Register `threads` new users at once for a new conference with
+    twice as many seats; returns (registered, sold out, failed, datastore
+    commits, registrations per second). Failed registrations ran out of
+    transaction retries; commits beyond one per registration are retries."""
+    import conference
+    import models
+    result = api(ORGANIZER).importConferences(models.ConferenceForms(items=[
+        models.ConferenceForm(name='Contention %d' % threads, city='Paris',
+                              maxAttendees=threads * 2)]))
+    request = conference.CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=result.items[0].websafeConferenceKey)
+    results = collections.Counter()
+    lock = threading.Lock()
+
+    def register(i):
+        try:
+            api('contender%d-%d@example.com' % (threads, i)).registerForConference(
+                request)
+            outcome = 'registered'
+        except models.ConflictException as e:
+            outcome = 'sold out' if 'no seats' in str(e) else 'failed'
+        except Exception:
+            outcome = 'failed'
+        with lock:
+            results[outcome] += 1
+
+    RPCS.clear()
+    workers = [threading.Thread(target=register, args=(i,))
+               for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    return (results['registered'], results['sold out'], results['failed'],
+            RPCS['datastore_v3.Commit'], results['registered'] / elapsed)
+
+
+def timeline(data):
+    """Register a new user for one conference; returns its API RPCs as
+    (ms, rpc number, 'issue' or 'done', service.call) in time order."""
+    import conference
+    request = conference.CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=data['conferences'][0])
+    service = api('timeline@example.com')
+    TIMELINE.reset()
+    try:
+        service.registerForConference(request)
+    finally:
+        TIMELINE.stop()
+    return TIMELINE.events
+
+
+def _reflect(message, convert, keyField):
+    """Return the per-entity hasattr/getattr copy that compileCopyPlan
+    replaced, for comparison."""
+    def copy(entity):
+        msg = message()
+        for field in msg.all_fields():
+            if hasattr(entity, field.name):
+                value = getattr(entity, field.name)
+                if field.name in convert:
+                    value = convert[field.name](value)
+                setattr(msg, field.name, value)
+            elif field.name == keyField:
+                setattr(msg, field.name, entity.key.urlsafe())
+        msg.check_initialized()
+        return msg
+    return copy
+
+
+def copyPlans(count):
+    """Copy count in-memory Conferences and Sessions to forms both ways;
+    returns (plan, reflection ms, compiled ms) rows."""
+    from google.appengine.ext import ndb
+    import conference
+    import models
+
+    today = datetime.date.today()
+    confs = [models.Conference(
+                key=ndb.Key(models.Conference, i + 1),
+                name='Conference %d' % i, description='All about Web',
+                organizerUserId=ORGANIZER, topics=['Web', 'Data'],
+                city='Paris', startDate=today, month=today.month,
+                endDate=today, maxAttendees=100, seatsAvailable=100)
+             for i in range(count)]
+    sessions = [models.Session(
+                    key=ndb.Key(models.Session, i + 1),
+                    sessionName='Session %d' % i, highlights=['Web'],
+                    speaker='Speaker 0', duration=60, typeOfSession='lecture',
+                    date=today, startTime=datetime.time(9, 0))
+                for i in range(count)]
+    cases = [
+        ('conferenceToForm', confs, conference.conferenceToForm,
+         _reflect(models.ConferenceForm, {'startDate': str, 'endDate': str},
+                  'websafeConferenceKey')),
+        ('sessionToForm', sessions, conference.sessionToForm,
+         _reflect(models.SessionForm, {'date': str, 'startTime': str},
+                  'websafeSessionKey')),
+    ]
+    rows = []
+    for name, entities, compiled, reflect in cases:
+        times = []
+        for copy in (reflect, compiled):
+            start = time.time()
+            for entity in entities:
+                copy(entity)
+            times.append((time.time() - start) * 1000)
+        rows.append((name,) + tuple(times))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--scale', nargs='+', default=['small'],
+                        choices=SCALES.keys())
+    parser.add_argument('--conferences', type=int, help='override scale')
+    parser.add_argument('--sessions', type=int, help='per conference')
+    parser.add_argument('--speakers', type=int, help='override scale')
+    parser.add_argument('--profiles', type=int, help='override scale')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='calls per endpoint, the first one cold')
+    parser.add_argument('--only', nargs='+', help='endpoint names to run')
+    parser.add_argument('--contention', type=int, nargs='+', default=[],
+                        help='concurrent registrations for one conference, '
+                             'one run per number')
+    parser.add_argument('--timeline', action='store_true',
+                        help='show the RPC order of one registration')
+    parser.add_argument('--copy-plans', action='store_true',
+                        help='time compiled copy plans against reflection')
+    parser.add_argument('--n-plus-one', action='store_true',
+                        help='fail if RPCs grow with items returned')
+    args = parser.parse_args(argv)
+
+    if args.copy_plans:
+        bed = setUp(args.sdk)
+        try:
+            print '%-20s %13s %13s %8s' % (
+                'plan', 'reflect ms', 'compiled ms', 'speedup')
+            for name, reflect, compiled in copyPlans(COPY_ENTITIES):
+                print '%-20s %13.1f %13.1f %7.1fx' % (
+                    name, reflect, compiled, reflect / compiled)
+        finally:
+            bed.deactivate()
+        return 0
+
+    if args.n_plus_one:
+        n, m, k, p = SCALES[args.scale[0]]
+        failed = nPlusOne(args, (args.conferences or n, args.sessions or m,
+                                 args.speakers or k, args.profiles or p))
+        if failed:
+            print '\nRPCs grow with result size: %s' % ', '.join(failed)
+            return 1
+        return 0
+
+    for scale in args.scale:
+        n, m, k, p = SCALES[scale]
+        n, m = args.conferences or n, args.sessions or m
+        k, p = args.speakers or k, args.profiles or p
+        bed = setUp(args.sdk)
+        try:
+            start = time.time()
+            data = generate(n, m, k, p)
+            print '\n%s: %d conferences, %d sessions, %d speakers, ' \
+                  '%d profiles (generated in %.1fs)' % (
+                      scale, n, n * m, k, p, time.time() - start)
+            print '%-32s %9s %9s %9s %9s %9s %8s' % (
+                'endpoint', 'cold ms', 'p50 ms', 'p95 ms',
+                'cold rpc', 'warm rpc', 'rss KB')
+            for name, call in calls():
+                if args.only and name not in args.only:
+                    continue
+                row = measure(call, data, args.repeat)
+                if isinstance(row, str):
+                    print '%-32s %s' % (name, row)
+                else:
+                    print '%-32s %9.1f %9.1f %9.1f %9d %9d %8d' % ((name,) + row)
+            if args.contention:
+                print '\n%-8s %10s %9s %7s %8s %8s' % (
+                    'threads', 'registered', 'sold out', 'failed',
+                    'commits', 'reg/s')
+                for threads in args.contention:
+                    print '%-8d %10d %9d %7d %8d %8.1f' % (
+                        (threads,) + contention(threads))
+            if args.timeline:
+                print '\nregisterForConference RPCs:'
+                for event in timeline(data):
+                    print '%8.1f ms  #%-3s %-5s %s' % event
+        finally:
+            bed.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
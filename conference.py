@@ -14,15 +14,19 @@ __author__ = 'mariesleaf@gmail.com (Marie Leaf)'
 
 
 from datetime import datetime, timedelta, time as timed
+import itertools
+import operator
 import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
@@ -32,15 +36,20 @@ from models import ProfileForm
 from models import StringMessage
 from models import BooleanMessage
 
+from models import AttendeeForm
+from models import AttendeeForms
 from models import Conference
+from models import ConferenceAttendee
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
+from models import UrlsafeKeyProperty
 
 from models import Session
 from models import SessionForm
+from models import SessionDay
 from models import SessionForms
 from models import SessionQueryForm
 from models import SessionQueryForms
@@ -49,6 +58,8 @@ from models import Speaker
 from models import SpeakerForm
 from models import SpeakerMiniForm
 from models import SpeakerList
+from models import SpeakerSessions
+from models import FeaturedSpeaker
 
 from models import SocialForm
 from models import SocialForms
@@ -59,6 +70,18 @@ from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
+from utils import compileCopyPlan
+from utils import getVersions
+from utils import bumpVersions
+from utils import bumpVersionsAsync
+from utils import UnitOfWork
+from utils import LocalCache
+from stats import countEvent
+from stats import instrumented
+import mailer
+import search
+import seats
+import social
 import logging
 logging.getLogger().setLevel(logging.DEBUG)
 
@@ -68,9 +91,26 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+# dict of websafeConferenceKey -> name behind the announcement
+MEMCACHE_NEARLY_SOLD_OUT_KEY = "NEARLY_SOLD_OUT"
+NEARLY_SOLD_OUT_SEATS = 5
+CAS_RETRIES = 5
 # Set MEMCACHE key to FEATURED SPEAKER
 MEMCACHE_FEATURED_SPEAKER = "FEATURED_SPEAKER"
+MEMCACHE_FEATURED_SPEAKER_CONF = "FEATURED_SPEAKER_%s"
+# rendered ConferenceForm, stamped with conference & organizer versions
+MEMCACHE_CONFERENCE_KEY = "CONFERENCE_%s"
+# rendered SpeakerList page, stamped with the SPEAKERS version
+MEMCACHE_SPEAKERS_KEY = "SPEAKERS_%s_%s"
+# rendered SessionForms of one day, stamped with the SESSIONS_<date> version
+MEMCACHE_SESSIONS_DAY_KEY = "SESSIONS_%s"
 FEATURED_SPEAKER_TPL = ("Our featured speaker is %s. For sessions: ")
+# seconds an instance serves the announcement & featured speaker without
+# asking memcache
+LOCAL_CACHE_TTL = 10
+# latest speaker to feature per conference, read by the coalesced task
+MEMCACHE_FEATURED_CANDIDATE = "FEATURED_CANDIDATE_%s"
+FEATURED_SPEAKER_WINDOW = 10    # seconds; one recompute per conference
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -100,6 +140,28 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# upper bound on pageSize for paged query endpoints
+MAX_PAGE_SIZE = 100
+
+# bulk imports: forms per request, entities per put_multi
+MAX_IMPORT_SIZE = 500
+IMPORT_CHUNK = 100
+
+# profiles per attendee index backfill task
+ATTENDEE_BACKFILL_PAGE = 100
+# speakers per SpeakerSessions backfill task
+SPEAKER_BACKFILL_PAGE = 50
+# sessions per SessionDay backfill task
+SESSION_BACKFILL_PAGE = 100
+
+# SessionDay buckets per date; spreads writes and bounds entity size
+SESSION_DAY_SHARDS = 10
+
+# queryConferences planner statistics: bounded match count per filter
+MEMCACHE_FILTER_COUNT_KEY = "CONF_FILTER_COUNT_%s_%s_%s"
+CONF_STATS_LIMIT = 1000
+CONF_STATS_TIME = 3600  # seconds
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -110,13 +172,43 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
-# in the midst of implementing
+ATTENDEE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1, required=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
 SESSIONFIELDS =    {
+            'NAME': 'sessionName',
+            'SPEAKER': 'speaker',
+            'TYPE': 'typeOfSession',
+            'HIGHLIGHTS': 'highlights',
+            'CONFERENCE': 'websafeConferenceKey',
             'DATE': 'date',
-            'TIME': 'time',
+            'TIME': 'startTime',
             'DURATION': 'duration',
-            'LOCATION': 'location',
-            'SEATSAVAILABLE': 'seatsavailable'
+            }
+
+# parse session filter values into the property's type; others are strings
+SESSION_PARSERS = {
+            'date': lambda v: datetime.strptime(v[:10], "%Y-%m-%d").date(),
+            'startTime': lambda v: datetime.strptime(v[:5], "%H:%M").time(),
+            'duration': int,
+            }
+
+# session fields, most selective first
+SESSION_SELECTIVITY = ['sessionName', 'speaker', 'websafeConferenceKey',
+                       'date', 'startTime', 'typeOfSession', 'highlights',
+                       'duration']
+
+COMPARATORS = {
+            '=':  operator.eq,
+            '>':  operator.gt,
+            '>=': operator.ge,
+            '<':  operator.lt,
+            '<=': operator.le,
+            '!=': operator.ne,
             }
 
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
@@ -130,11 +222,27 @@ SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     speaker=messages.StringField(1, required=True),
 )
 
+PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+)
+
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1, required=True),
 )
 
+SESSION_IMPORT_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1, required=True),
+)
+
+FOLLOW_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    userId=messages.StringField(1, required=True),
+)
+
 WISH_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1),
@@ -145,6 +253,31 @@ WISH_POST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1),
 )
 
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, required=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+
+# per-instance cache of MEMCACHE_ANNOUNCEMENTS_KEY & MEMCACHE_FEATURED_SPEAKER
+localCache = LocalCache('hot', LOCAL_CACHE_TTL)
+
+# entity -> form converters, compiled once at import
+conferenceToForm = compileCopyPlan(Conference, ConferenceForm,
+    # convert Date to date string; just copy others
+    convert={'startDate': str, 'endDate': str},
+    keyField='websafeConferenceKey')
+sessionToForm = compileCopyPlan(Session, SessionForm,
+    convert={'date': str, 'startTime': str},
+    keyField='websafeSessionKey')
+speakerToForm = compileCopyPlan(Speaker, SpeakerForm)
+speakerToMiniForm = compileCopyPlan(Speaker, SpeakerMiniForm)
+profileToForm = compileCopyPlan(Profile, ProfileForm,
+    # convert t-shirt string to Enum, keys to websafe keys; just copy others
+    convert={'teeShirtSize': lambda size: getattr(TeeShirtSize, size),
+             'conferenceKeysToAttend': lambda keys: [k.urlsafe() for k in keys]})
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -155,33 +288,50 @@ WISH_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # request-scoped state, reset by initialize_request_state
+    _scope = None
+    _user = None
+    _user_id = None
+
+    def initialize_request_state(self, state):
+        """Start every request with an empty identity map."""
+        super(ConferenceApi, self).initialize_request_state(state)
+        self._scope = self._user = self._user_id = None
+
+    @property
+    def _uow(self):
+        """This request's UnitOfWork."""
+        if self._scope is None:
+            self._scope = UnitOfWork()
+        return self._scope
+
+    def _currentUser(self):
+        """Return the authed user, once per request; bail if there is none."""
+        if self._user is None:
+            self._user = endpoints.get_current_user()
+        if not self._user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self._user
+
+    def _currentUserId(self):
+        """Return getUserId of the authed user, once per request."""
+        user = self._currentUser()
+        if self._user_id is None:
+            self._user_id = getUserId(user)
+        return self._user_id
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeConferenceKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        cf = conferenceToForm(conf)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+            cf.organizerDisplayName = displayName
         return cf
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    def _conferenceDataFromForm(self, request):
+        """Return Conference property dict for a new conference's form."""
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeConferenceKey']
@@ -205,6 +355,15 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        user = self._currentUser()
+        user_id = self._currentUserId()
+
+        data = self._conferenceDataFromForm(request)
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -213,22 +372,21 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        # create Conference with its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        conf = Conference(**data)
+        ndb.put_multi([conf] + seats.newShards(conf))
+        # index task and batched confirmation email, queued in parallel
+        index_rpc = taskqueue.Queue().add_async(search.indexTask(c_key))
+        mailer.queueConfirmationsAsync(user.email(), [request]).get_result()
+        index_rpc.get_result()
         return request
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._currentUser()
+        user_id = self._currentUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -245,10 +403,20 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # seats are owned by the shards; resize them with maxAttendees
+        resized = request.maxAttendees not in (None, conf.maxAttendees)
+        if resized:
+            delta = request.maxAttendees - (conf.maxAttendees or 0)
+            if conf.seatShards:
+                seats.resize(conf, delta)
+            conf.seatsAvailable = max((conf.seatsAvailable or 0) + delta, 0)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
+            if field.name == 'seatsAvailable':
+                continue
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
@@ -259,18 +427,81 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        search.scheduleIndex(conf.key, transactional=True)
+        # drop cached form and refresh the announcement once the write
+        # is visible
+        def on_commit():
+            if resized and conf.seatShards:
+                # recount the shards before the form can be re-rendered
+                seats.flushSeats(conf.key)
+                seats.scheduleSync(conf.key)
+            bumpVersions(request.websafeConferenceKey)
+            if resized:
+                # the shard total, not the denormalized copy that
+                # registrations since the last sync have not reached
+                self._noteSeatsAvailable(request.websafeConferenceKey,
+                                         conf.name, seats.seatsAvailable(conf))
+        ndb.get_context().call_on_commit(on_commit)
+        prof = self._uow.get(ndb.Key(Profile, user_id))
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    @endpoints.method(ConferenceForms, ConferenceForms,
+            path='conferences/import',
+            http_method='POST', name='importConferences')
+    @instrumented
+    def importConferences(self, request):
+        """Create a batch of conferences, returned with their keys."""
+        user = self._currentUser()
+        user_id = self._currentUserId()
+        self._checkImportSize(request.items)
+
+        # one id range for the whole batch
+        p_key = ndb.Key(Profile, user_id)
+        first, _ = Conference.allocate_ids(size=len(request.items), parent=p_key)
+        entities = []
+        c_keys = []
+        for i, form in enumerate(request.items):
+            data = self._conferenceDataFromForm(form)
+            data['key'] = ndb.Key(Conference, first + i, parent=p_key)
+            data['organizerUserId'] = form.organizerUserId = user_id
+            form.websafeConferenceKey = data['key'].urlsafe()
+            conf = Conference(**data)
+            entities += [conf] + seats.newShards(conf)
+            c_keys.append(conf.key)
+        self._putChunked(entities)
+
+        # one search task per chunk; confirmations go out as one digest
+        search.scheduleIndexMulti(c_keys)
+        mailer.queueConfirmations(user.email(), request.items)
+        return request
+
+    @staticmethod
+    def _checkImportSize(items):
+        """Bail on an empty or oversized import batch."""
+        if not items or len(items) > MAX_IMPORT_SIZE:
+            raise endpoints.BadRequestException(
+                "Import between 1 and %d items at a time." % MAX_IMPORT_SIZE)
+
+    @staticmethod
+    def _putChunked(entities):
+        """Write entities IMPORT_CHUNK at a time, batches in parallel."""
+        futures = []
+        for i in range(0, len(entities), IMPORT_CHUNK):
+            futures += ndb.put_multi_async(entities[i:i + IMPORT_CHUNK])
+        for future in futures:
+            future.get_result()
+
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
@@ -278,60 +509,115 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        cache_key = MEMCACHE_CONFERENCE_KEY % wsck
+
+        # serve the rendered form while neither conference nor organizer
+        # changed; stamps are read before the datastore so a racing write
+        # leaves us storing an entry that is already stale
+        versions = getVersions([wsck, c_key.parent().urlsafe()])
+        cached = memcache.get(cache_key)
+        if cached and cached[0] == versions:
+            return protojson.decode_message(ConferenceForm, cached[1])
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
+                'No conference found with key: %s' % wsck)
         prof = conf.key.parent().get()
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # live seat count from the shards
+        cf.seatsAvailable = seats.seatsAvailable(conf)
+        memcache.set(cache_key, (versions, protojson.encode_message(cf)))
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._currentUser()
+        user_id = self._currentUserId()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        prof = self._uow.get(ndb.Key(Profile, user_id))
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
         )
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+        """Return (query, filters, plan) for the submitted filters.
+        Only the cheapest filter is pushed to the datastore, so index.yaml
+        needs just one (field, name) index per filterable field; the
+        others are applied in memory.
+        """
+        filters = self._formatFilters(request.filters)
+
+        # != would split into two datastore queries; never push it
+        candidates = [f for f in filters if f["operator"] != "!="]
+        pushed = []
+        estimates = []
+        if candidates:
+            estimates = zip(self._estimateMatches(candidates), candidates)
+            best = min(estimates, key=lambda e: e[0])[1]
+            pushed = [best]
+            if best["operator"] != "=":
+                # other bounds on the same field share the index
+                pushed += [f for f in candidates if f is not best and
+                           f["field"] == best["field"] and f["operator"] != "="]
+
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+        for filtr in pushed:
+            q = q.filter(self._filterNode(Conference, filtr))
 
         # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
+        if pushed and pushed[0]["operator"] != "=":
+            q = q.order(getattr(Conference, pushed[0]["field"]))
+        q = q.order(Conference.name)
+
+        plan = 'datastore: %s; in memory: %s; estimates: %s' % (
+            ', '.join('%(field)s %(operator)s' % f for f in pushed) or 'scan',
+            ', '.join('%(field)s %(operator)s' % f for f in filters
+                      if f not in pushed) or 'none',
+            ', '.join('%s %s %d' % (f["field"], f["operator"], n)
+                      for n, f in estimates) or 'none')
+        logging.debug('queryConferences plan: %s', plan)
+        return q, filters, plan
+
+    def _estimateMatches(self, filters):
+        """Return estimated number of conferences matching each filter.
+        Estimates are bounded keys-only counts, run in parallel and kept
+        in memcache for CONF_STATS_TIME.
+        """
+        keys = [MEMCACHE_FILTER_COUNT_KEY % (f["field"], f["operator"], f["value"])
+                for f in filters]
+        counts = memcache.get_multi(keys)
+        futures = {}
+        for filtr, key in zip(filters, keys):
+            if key not in counts and key not in futures:
+                futures[key] = Conference.query(
+                    self._filterNode(Conference, filtr)).count_async(
+                        limit=CONF_STATS_LIMIT)
+        if futures:
+            fresh = dict((key, future.get_result())
+                         for key, future in futures.items())
+            memcache.set_multi(fresh, time=CONF_STATS_TIME)
+            counts.update(fresh)
+        return [counts[key] for key in keys]
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -339,91 +625,167 @@ class ConferenceApi(remote.Service):
             try:
                 filtr["field"] = FIELDS[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
-            except KeyError:
-                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
-
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+                if filtr["field"] in ["month", "maxAttendees"]:
+                    filtr["value"] = int(filtr["value"])
+            except (KeyError, ValueError, TypeError):
+                raise endpoints.BadRequestException("Filter contains invalid field, operator or value.")
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
+
+    @staticmethod
+    def _filterNode(model, filtr):
+        """Return the ndb filter for a formatted filter on model."""
+        return COMPARATORS[filtr["operator"]](
+            getattr(model, filtr["field"]), filtr["value"])
+
+    @staticmethod
+    def _matchesFilters(entity, filters):
+        """Return True if entity passes every formatted filter."""
+        for f in filters:
+            value = getattr(entity, f["field"])
+            compare = COMPARATORS[f["operator"]]
+            # repeated properties match if any value does, as in datastore
+            values = value if isinstance(value, list) else [value]
+            # unset values never satisfy an ordering
+            if not any(compare(v, f["value"]) for v in values
+                       if v is not None or f["operator"] in ("=", "!=")):
+                return False
+        return True
+
+    def _runFiltered(self, q, filters, page_size=None, page_token=None):
+        """Stream q through the in-memory filters until a page is full.
+        Returns (entities, next page token).
+        """
+        if page_size is not None:
+            self._checkPageSize(page_size)
+        it = q.iter(start_cursor=self._getCursor(page_token),
+                    produce_cursors=True)
+
+        items = []
+        for entity in it:
+            if self._matchesFilters(entity, filters):
+                items.append(entity)
+                if len(items) == page_size:
+                    break
+
+        next_token = None
+        if page_size and len(items) == page_size and it.has_next():
+            next_token = it.cursor_after().urlsafe()
+        return items, next_token
+
+
+    def _getOrganizerNames(self, confs):
+        """Return dict of organizer user id -> displayName for confs."""
+        # one get_multi over the distinct organizers of this batch
+        user_ids = set(conf.organizerUserId for conf in confs)
+        profiles = ndb.get_multi([ndb.Key(Profile, uid) for uid in user_ids])
+        return dict((profile.key.id(), profile.displayName)
+                    for profile in profiles if profile)
+
+    @staticmethod
+    def _checkPageSize(page_size):
+        """Bail on a pageSize outside 1..MAX_PAGE_SIZE."""
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
 
+    @staticmethod
+    def _getCursor(page_token):
+        """Return the datastore Cursor for a pageToken, or None."""
+        try:
+            return Cursor(urlsafe=page_token) if page_token else None
+        except Exception:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+
+    def _slicePage(self, items, page_size, page_token):
+        """Return one page of an in-memory list and the next page token;
+        the token is an offset. Without a page_size all items are returned.
+        """
+        if page_size is None:
+            return items, None
+        self._checkPageSize(page_size)
+        try:
+            offset = int(page_token or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        end = offset + page_size
+        return items[offset:end], (str(end) if end < len(items) else None)
+
+    def _fetchPage(self, q, page_size, page_token):
+        """Fetch one page of q, returning (entities, next page token).
+        Without a page_size the whole result set is fetched in one pass.
+        """
+        if page_size is None:
+            return q.fetch(), None
+        self._checkPageSize(page_size)
+        cursor = self._getCursor(page_token)
+        items, next_cursor, more = q.fetch_page(page_size, start_cursor=cursor)
+        if more and next_cursor:
+            return items, next_cursor.urlsafe()
+        return items, None
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, optionally one page at a time."""
+        # run the query once; iterating a Query re-executes it
+        q, filters, plan = self._getQuery(request)
+        conferences, next_token = self._runFiltered(
+            q, filters, request.pageSize, request.pageToken)
 
         # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        names = self._getOrganizerNames(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId)) for conf in \
+                conferences],
+                nextPageToken=next_token,
+                queryPlan=plan
         )
 
 
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+            path='searchConferences',
+            http_method='GET',
+            name='searchConferences')
+    @instrumented
+    def searchConferences(self, request):
+        """Keyword search over conference name, topics and description."""
+        keys, truncated = search.search('Conference', request.query)
+        c_keys, next_token = self._slicePage(
+            keys, request.pageSize, request.pageToken)
+        conferences = [conf for conf in ndb.get_multi(c_keys) if conf]
+        names = self._getOrganizerNames(conferences)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextPageToken=next_token,
+            truncated=truncated)
+
+
 # - - - Session objects - - - - - - - - - - - - - - - - - - - -
 
     def _copySessionToForm(self, sesh):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sesh, field.name):
-                # convert Date to date string; just copy others
-                if field.name in ['startTime', 'date']:
-                    setattr(sf, field.name, str(getattr(sesh, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sesh, field.name))
-            elif field.name == "websafeSessionKey":
-                setattr(sf, field.name, sesh.key.urlsafe())
-        sf.check_initialized()
-        return sf
-
-    def _createSessionObject(self, request):
-        """open only to the organizer of the conference"""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        return sessionToForm(sesh)
 
+    def _sessionDataFromForm(self, request):
+        """Check a new session's form and return its Session property dict."""
         if not request.sessionName:
             raise endpoints.BadRequestException("Session 'name' field required")
+        if not request.speaker:
+            raise endpoints.BadRequestException("Session 'speaker' field required")
 
         # copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeSessionKey']
-        # del data['websafeConferenceKey']
-
-        # fetch and check conferencee
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-
-        # ensure user is owner
-        if user_id != conf.organizerUserId:
-            raise endpoints.ForbiddenException(
-                'Only the owner can add sessions.')
 
         # add default values for those missing (both data model & outbound Message)
         for df in SESHDEFAULTS:
@@ -431,7 +793,7 @@ class ConferenceApi(remote.Service):
                 data[df] = SESHDEFAULTS[df]
                 setattr(request, df, SESHDEFAULTS[df])
 
-        # convert dates from strings to Date objects; set month based on start_date
+        # convert dates from strings to Date objects
         if data['date']:
             data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
 
@@ -442,71 +804,335 @@ class ConferenceApi(remote.Service):
         # converts type of session to string (TODO set as dropdown menu)
         if data['typeOfSession']:
             data['typeOfSession'] = str(data['typeOfSession'])
+        return data
 
+    def _createSessionObject(self, request):
+        """open only to the organizer of the conference"""
+        # preload necessary data items
+        user = self._currentUser()
+        user_id = self._currentUserId()
 
-        # generate Session Key based on Conference key and organizer
-        # ID based on Profile key get Conference key from ID
-        c_key = ndb.Key(Conference, conf.key.id())
-        # may not be necessary, but chosing to keep separate session ID
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        data['key'] = s_key
-        data['organizerUserId'] = request.organizerUserId = user_id
-        # del data['websafeConferenceKey'] (need this to set speaker below)
-        # del data['websafeSessionkey'] (only need to put if updating?)
-        # del data['organizerUserId']
+        data = self._sessionDataFromForm(request)
 
-        # Session(**data).put()
-        speaker = request.speaker
-        logging.debug(speaker)
-        spkr = request.speaker
-        logging.debug(spkr)
+        # Session Key is based on a root Conference key with the same ID,
+        # so conference get, speaker get and id allocation can overlap
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        c_key = ndb.Key(Conference, conf_key.id())
+        conf_future = conf_key.get_async()
+        speaker_future = ndb.Key(Speaker, data['speaker']).get_async()
+        ids_future = Session.allocate_ids_async(size=1, parent=c_key)
+
+        # fetch and check conferencee
+        conf = conf_future.get_result()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+
+        # ensure user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can add sessions.')
 
         # get and check speaker
-        if data['speaker']:
-            sp_key = ndb.Key(Speaker,data['speaker']).get()
-            logging.debug("THIS IS WHERE THE SP_KEY SHOULD BE RETRIEVED:")
-            logging.debug(sp_key)
-            if not sp_key:
-                raise endpoints.NotFoundException(
-                    'No speaker "%s" found. Please first "addspeaker".' % data['speaker'])
-
-
-        sessKeys=getattr(sp_key, "sessionKeys")
-        logging.debug("THIS IS WHERE THE SESSKEYS SHOULD BE:")
-        logging.debug(sessKeys)
-        count=1
-        # determine how many sessions this speaker is presenting at this conference
-        if sessKeys:
-            for wskey in sessKeys:
-                if ndb.Key(urlsafe=wskey).parent()==c_key:
-                    logging.info("session id=%d"%ndb.Key(urlsafe=wskey).id())
-                    count+=1
-
-        # create Session
+        if not speaker_future.get_result():
+            raise endpoints.NotFoundException(
+                'No speaker "%s" found. Please first "addspeaker".' % data['speaker'])
+
+        s_key = ndb.Key(Session, ids_future.get_result()[0], parent=c_key)
+        data['key'] = s_key
+        data['organizerUserId'] = request.organizerUserId = user_id
+
+        # create Session and index it under (speaker, conference)
         try:
-            Session(**data).put()
-            sp_key.sessionKeys.append(s_key.urlsafe())
-            sp_key.put()
-        except:
+            count = self._putSessionTxn(Session(**data))
+        except Exception:
+            logging.exception("Session put failed")
             raise endpoints.BadRequestException("Database update failed")
 
-
+        # day cache bump and featured speaker task are independent
+        rpcs = []
+        if data['date']:
+            rpcs.append(bumpVersionsAsync(
+                MEMCACHE_SESSIONS_DAY_KEY % data['date'].isoformat()))
 
         # If number of sessions greater than one set featured speaker
         if count >= 2:
-            # for spkr in data['speaker']:
-                taskqueue.add(
-                    params={'speaker': spkr,
-                            'websafeConferenceKey': request.websafeConferenceKey},
-                    url='/tasks/set_featured_speaker')
+            self._scheduleFeaturedSpeaker(request.websafeConferenceKey,
+                                          data['speaker'])
+
+        for rpc in rpcs:
+            rpc.get_result()
+        return request
+
+    @ndb.transactional(xg=True)
+    def _putSessionTxn(self, session):
+        """Put session and add it to its SpeakerSessions and SessionDay
+        indexes; returns how many sessions the speaker now has at this
+        conference."""
+        # index shares the session's entity group (its conference key)
+        idx_key = ndb.Key(SpeakerSessions, session.speaker,
+                          parent=session.key.parent())
+        day_key = self._sessionDayKey(session.key, session.date) if session.date else None
+        # read both indexes in one batch
+        idx, day = ndb.get_multi([idx_key, day_key]) if day_key else (idx_key.get(), None)
+        idx = idx or SpeakerSessions(key=idx_key, speaker=session.speaker)
+        idx.sessionKeys.append(session.key)
+        entities = [session, idx]
+        if day_key:
+            day = day or SessionDay(key=day_key, date=session.date)
+            day.sessionKeys.append(session.key)
+            entities.append(day)
+        ndb.put_multi(entities)
+        search.scheduleIndex(session.key, transactional=True)
+        return len(idx.sessionKeys)
+
+
+    @endpoints.method(SESSION_IMPORT_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions/import',
+                      http_method='POST', name='importSessions')
+    @instrumented
+    def importSessions(self, request):
+        """Create a batch of sessions (an agenda) for one conference.
+        Open to the organizer of the conference."""
+        user = self._currentUser()
+        user_id = self._currentUserId()
+        self._checkImportSize(request.items)
+
+        # fetch and check conference; ensure user is owner
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can add sessions.')
+
+        datas = []
+        for form in request.items:
+            form.websafeConferenceKey = request.websafeConferenceKey
+            datas.append(self._sessionDataFromForm(form))
+
+        # check every speaker with one get_multi
+        names = sorted(set(data['speaker'] for data in datas))
+        speakers = ndb.get_multi([ndb.Key(Speaker, name) for name in names])
+        missing = [name for name, sp in zip(names, speakers) if not sp]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No speaker "%s" found. Please first "addspeaker".' % '", "'.join(missing))
+
+        # one id range for the whole agenda
+        c_key = ndb.Key(Conference, conf.key.id())
+        first, _ = Session.allocate_ids(size=len(datas), parent=c_key)
+        sessions = []
+        for i, (form, data) in enumerate(zip(request.items, datas)):
+            data['key'] = ndb.Key(Session, first + i, parent=c_key)
+            data['organizerUserId'] = form.organizerUserId = user_id
+            form.websafeSessionKey = data['key'].urlsafe()
+            sessions.append(Session(**data))
+        self._putChunked(sessions)
+
+        counts = self._indexImportedSessions(c_key, sessions)
+        search.scheduleIndexMulti([session.key for session in sessions])
+
+        # feature this conference's busiest speaker, once for the agenda
+        speaker, count = max(counts.items(), key=lambda c: c[1])
+        if count >= 2:
+            self._scheduleFeaturedSpeaker(request.websafeConferenceKey, speaker)
 
         return request
 
+    def _indexImportedSessions(self, c_key, sessions):
+        """Add imported sessions to the SpeakerSessions and SessionDay
+        indexes; returns speaker -> sessions at this conference."""
+        by_speaker = {}
+        for session in sessions:
+            by_speaker.setdefault(session.speaker, []).append(session.key)
+        self._addToSessionDays(sessions)
+        return self._addToSpeakerSessionsTxn(c_key, by_speaker)
+
+    @staticmethod
+    @ndb.transactional()
+    def _addToSpeakerSessionsTxn(c_key, by_speaker):
+        idx_keys = [ndb.Key(SpeakerSessions, name, parent=c_key) for name in by_speaker]
+        idxs = [idx or SpeakerSessions(key=key, speaker=key.id())
+                for key, idx in zip(idx_keys, ndb.get_multi(idx_keys))]
+        for idx in idxs:
+            # skip keys already indexed, so backfills can be rerun
+            idx.sessionKeys.extend(s_key for s_key in by_speaker[idx.speaker]
+                                   if s_key not in idx.sessionKeys)
+        ndb.put_multi(idxs)
+        return dict((idx.speaker, len(idx.sessionKeys)) for idx in idxs)
+
+    @staticmethod
+    def _backfillSpeakerSessions(page_token=None):
+        """Index the sessions listed in one page of Speakers' old
+        sessionKeys property in SpeakerSessions, then remove the property;
+        returns the next page token or None. Safe to rerun."""
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        speakers, next_cursor, more = Speaker.query().fetch_page(
+            SPEAKER_BACKFILL_PAGE, start_cursor=cursor)
+        # sessionKeys is no longer on the model; ndb keeps the stored
+        # urlsafe strings as a generic property of the loaded entity
+        s_keys = []
+        for speaker in speakers:
+            prop = speaker._properties.get('sessionKeys')
+            if prop:
+                s_keys += [ndb.Key(urlsafe=wssk)
+                           for wssk in prop._get_value(speaker) or []]
+        # group by the sessions' own conference and speaker, as
+        # _putSessionTxn does; sessions since deleted are skipped
+        by_conf = {}
+        for session in ndb.get_multi(s_keys):
+            if session:
+                by_speaker = by_conf.setdefault(session.key.parent(), {})
+                by_speaker.setdefault(session.speaker, []).append(session.key)
+        for c_key, by_speaker in by_conf.items():
+            ConferenceApi._addToSpeakerSessionsTxn(c_key, by_speaker)
+        # indexed; now drop the old list so speakers stop loading it
+        for speaker in speakers:
+            if 'sessionKeys' in speaker._properties:
+                ConferenceApi._dropSpeakerSessionKeysTxn(speaker.key)
+        return next_cursor.urlsafe() if more and next_cursor else None
+
+    @staticmethod
+    @ndb.transactional()
+    def _dropSpeakerSessionKeysTxn(sp_key):
+        """Remove the old sessionKeys property from a stored Speaker."""
+        speaker = sp_key.get()
+        if speaker and 'sessionKeys' in speaker._properties:
+            del speaker._properties['sessionKeys']
+            speaker._values.pop('sessionKeys', None)
+            speaker.put()
+
+    @staticmethod
+    def _sessionDayKey(s_key, date):
+        """Return the key of the SessionDay shard that lists session s_key."""
+        return ndb.Key(SessionDay, '%s:%d' % (
+            date.isoformat(), s_key.id() % SESSION_DAY_SHARDS))
+
+    @staticmethod
+    def _sessionDayKeys(date):
+        """Return the keys of every SessionDay shard of date."""
+        return [ndb.Key(SessionDay, '%s:%d' % (date.isoformat(), i))
+                for i in range(SESSION_DAY_SHARDS)]
+
+    @staticmethod
+    def _addToSessionDays(sessions):
+        """Add dated sessions to their SessionDay shards, one transaction
+        per shard, and drop the cached lists of their dates."""
+        by_day = {}
+        for session in sessions:
+            if session.date:
+                day_key = ConferenceApi._sessionDayKey(session.key, session.date)
+                by_day.setdefault(day_key, (session.date, []))[1].append(session.key)
+        for day_key, (date, s_keys) in by_day.items():
+            ConferenceApi._addToSessionDayTxn(day_key, date, s_keys)
+        dates = set(date.isoformat() for date, _ in by_day.values())
+        if dates:
+            bumpVersions(*[MEMCACHE_SESSIONS_DAY_KEY % date for date in dates])
+
+    @staticmethod
+    @ndb.transactional()
+    def _addToSessionDayTxn(day_key, date, s_keys):
+        day = day_key.get() or SessionDay(key=day_key, date=date)
+        # skip keys already listed, so backfills can be rerun
+        day.sessionKeys.extend(s_key for s_key in s_keys
+                               if s_key not in day.sessionKeys)
+        day.put()
+
+    @staticmethod
+    def _backfillSessionDays(page_token=None):
+        """List one page of existing sessions in their SessionDay shards and
+        delete the unsharded buckets of their dates; returns the next page
+        token or None. Safe to rerun."""
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            SESSION_BACKFILL_PAGE, start_cursor=cursor)
+        ConferenceApi._addToSessionDays(sessions)
+        ndb.delete_multi(set(ndb.Key(SessionDay, session.date.isoformat())
+                             for session in sessions if session.date))
+        return next_cursor.urlsafe() if more and next_cursor else None
+
+
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and type user supplied session filters."""
+        formatted_filters = []
+        for f in filters:
+            try:
+                field = SESSIONFIELDS[f.field]
+                formatted_filters.append({
+                    'field': field,
+                    'operator': OPERATORS[f.operator],
+                    'value': SESSION_PARSERS.get(field, lambda v: v)(f.value),
+                })
+            except (KeyError, ValueError, TypeError):
+                raise endpoints.BadRequestException(
+                    "Filter contains invalid field, operator or value.")
+        return formatted_filters
+
+    def _planSessionQuery(self, filters):
+        """Return (query, plan) pushing only filters the built-in single
+        property indexes can serve; the rest are applied in memory."""
+        # equality filters are merge-joined without composite indexes
+        pushed = [f for f in filters if f['operator'] == '=']
+        if not pushed:
+            # one inequality property per query; take the most selective.
+            # != is never pushed, the datastore would split it in two
+            ranges = [f for f in filters if f['operator'] not in ('=', '!=')]
+            if ranges:
+                best = min(ranges, key=lambda f: SESSION_SELECTIVITY.index(f['field']))
+                pushed = [f for f in ranges if f['field'] == best['field']]
+
+        q = Session.query()
+        for f in pushed:
+            q = q.filter(self._filterNode(Session, f))
+        plan = 'datastore: %s; in memory: all %d filters' % (
+            ', '.join('%(field)s %(operator)s' % f for f in pushed) or 'scan',
+            len(filters))
+        return q, plan
+
+    def _runSessionQuery(self, filters, page_size=None, page_token=None):
+        """Run planned session filters; returns (sessions, next page token)."""
+        q, plan = self._planSessionQuery(filters)
+        logging.debug('querySessions plan: %s', plan)
+        return self._runFiltered(q, filters, page_size, page_token)
+
+    @endpoints.method(SessionQueryForms, SessionForms,
+            path='querySessions',
+            http_method='POST',
+            name='querySessions')
+    @instrumented
+    def querySessions(self, request):
+        """Query for sessions, optionally one page at a time."""
+        sessions, next_token = self._runSessionQuery(
+            self._formatSessionFilters(request.filters),
+            request.pageSize, request.pageToken)
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
+
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+            path='searchSessions',
+            http_method='GET',
+            name='searchSessions')
+    @instrumented
+    def searchSessions(self, request):
+        """Keyword search over session name and highlights."""
+        keys, truncated = search.search('Session', request.query)
+        s_keys, next_token = self._slicePage(
+            keys, request.pageSize, request.pageToken)
+        sessions = [session for session in ndb.get_multi(s_keys) if session]
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token,
+            truncated=truncated)
+
 
     @endpoints.method(SessionForm, SessionForm,
                       path='conference/{websafeConferenceKey}/sessions/new',
                       http_method='POST', name='createSession')
+    @instrumented
     def createSession(self, request):
         """Open to the organizer of the conference"""
         return self._createSessionObject(request)
@@ -514,6 +1140,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms, path='conference/{websafeConferenceKey}/sessions',
             http_method='GET', name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
         """Return requested sessions (by websafeConferenceKey)."""
 
@@ -536,6 +1163,7 @@ class ConferenceApi(remote.Service):
                       path='sessions/{websafeConferenceKey}/{typeOfSession}',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Return requested session (by session type)"""
 
@@ -558,62 +1186,77 @@ class ConferenceApi(remote.Service):
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
         # copy relevant fields from Speaker to SpeakerFrom
-        spkr = SpeakerForm()
-        for field in spkr.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(spkr, field.name, getattr(speaker, field.name))
-        spkr.check_initialized()
+        spkr = speakerToForm(speaker)
+        # session keys live in the per-conference SpeakerSessions index
+        spkr.sessionKeys = [s_key.urlsafe()
+            for idx in SpeakerSessions.query(SpeakerSessions.speaker == speaker.displayName)
+            for s_key in idx.sessionKeys]
         return spkr
 
     def _copySpeakerToMiniForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
         # copy relevant fields from Speaker to SpeakerMiniForm
-        spkr = SpeakerMiniForm()
-        for field in spkr.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(spkr, field.name, getattr(speaker, field.name))
-        spkr.check_initialized()
-        return spkr
+        return speakerToMiniForm(speaker)
 
     def _doSpeaker(self, request):
         """Get, create or update speaker"""
         sp_key = ndb.Key(Speaker,request.displayName)
         speaker = sp_key.get()
+        changed = False
         # if speaker exists, process user-modifyable fields
         if speaker:
             for field in ('displayName', 'bio'):
                 if hasattr(request, field):
                     val = getattr(request, field)
-                    if val:
+                    if val and getattr(speaker, field) != str(val):
                         setattr(speaker, field, str(val))
+                        changed = True
         # if speaker doesn't exist, create new speaker object
         else:
             speaker = Speaker(key=sp_key,
                               displayName=request.displayName,
                               mainEmail=request.mainEmail,
-                              bio=request.bio,
-                              sessionKeys= [])
-        # put the modified speaker to datastore
-        speaker.put()
+                              bio=request.bio)
+            changed = True
+        # put the modified speaker to datastore, invalidate the directory
+        if changed:
+            speaker.put()
+            bumpVersions('SPEAKERS')
 
         # return SpeakerForm
         return self._copySpeakerToForm(speaker)
 
     @endpoints.method(SpeakerForm, SpeakerForm,
             path='speaker', http_method='GET', name='getSpeaker')
+    @instrumented
     def getSpeaker(self, request):
         """Return speaker info."""
         return self._doSpeaker(request)
 
-    @endpoints.method(message_types.VoidMessage, SpeakerList,
+    @endpoints.method(PAGE_GET_REQUEST, SpeakerList,
             path='allspeakers', http_method='GET', name='getAllSpeaker')
+    @instrumented
     def getAllSpeakers(self, request):
-        """Return list of speakers."""
-        speakers=Speaker.query().order(Speaker.displayName)
-        return SpeakerList(items=[self._copySpeakerToMiniForm(speaker) for speaker in speakers])
+        """Return list of speakers, optionally one page at a time."""
+        cache_key = MEMCACHE_SPEAKERS_KEY % (request.pageSize, request.pageToken)
+        versions = getVersions(['SPEAKERS'])
+        cached = memcache.get(cache_key)
+        if cached and cached[0] == versions:
+            return protojson.decode_message(SpeakerList, cached[1])
+
+        # project only what SpeakerMiniForm needs, skipping bio
+        q = Speaker.query(projection=[Speaker.displayName, Speaker.mainEmail])
+        speakers, next_token = self._fetchPage(
+            q.order(Speaker.displayName), request.pageSize, request.pageToken)
+        speaker_list = SpeakerList(
+            items=[self._copySpeakerToMiniForm(speaker) for speaker in speakers],
+            nextPageToken=next_token)
+        memcache.set(cache_key, (versions, protojson.encode_message(speaker_list)))
+        return speaker_list
 
     @endpoints.method(SpeakerForm, SpeakerForm,
             path='addSpeaker', http_method='POST', name='addSpeaker')
+    @instrumented
     def addSpeaker(self, request):
         """Update & return user speaker."""
         return self._doSpeaker(request)
@@ -623,6 +1266,7 @@ class ConferenceApi(remote.Service):
                       path='sessions/speaker',
                       http_method='GET',
                       name='getConferenceSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """Return requested sessions (by speaker)"""
         # query for sessions with this speaker as a match
@@ -636,14 +1280,13 @@ class ConferenceApi(remote.Service):
                       path='conference/session/{websafeSessionKey}/wishlist/add', # necessarily want to add the websafeConferenceKey and websadesessionkey in the url here??
                       http_method='POST',
                       name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """Adds a session to current user's wishlist"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        self._currentUser()
 
         # get and check session
-        session = ndb.Key(urlsafe=request.websafeSessionKey).get()
+        session = self._uow.get(ndb.Key(urlsafe=request.websafeSessionKey))
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.websafeSessionKey)
@@ -658,41 +1301,48 @@ class ConferenceApi(remote.Service):
 
         # append to user profile's wishlist
         prof.sessKeyWishlist.append(session.key)
-        prof.put()
+        self._uow.save(prof)
+        self._uow.flush()
 
         return self._copySessionToForm(session)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(PAGE_GET_REQUEST, SessionForms,
             http_method='POST', name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
-        """Returns a user's session wishlist"""
+        """Returns a user's session wishlist, optionally one page at a time"""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        self._currentUser()
 
         # get profile and wishlist
         prof = self._getProfileFromUser()
         s_keys = prof.sessKeyWishlist
-        sessions = [s_key.get() for s_key in s_keys]
+
+        # the wishlist is a list on the Profile, so the page token is an offset
+        s_keys, next_token = self._slicePage(
+            s_keys, request.pageSize, request.pageToken)
+
+        # one batch get; sessions deleted since being wishlisted come back None
+        sessions = [session for session in self._uow.getMulti(s_keys) if session]
+        self._uow.flush()
 
         # return list of sessions
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
 
 
     @endpoints.method(WISH_POST_REQUEST, SessionForm,
                       path='conference/session/{websafeSessionKey}/wishlist/delete', # necessarily want to add the websafeConferenceKey and websadesessionkey in the url here??
                       http_method='POST',
                       name='deleteSessionInWishlist')
+    @instrumented
     def delete_session_from_wishlist(self, request):
         """Removes session from user's wishlist"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        self._currentUser()
 
         # get and check session
-        session = ndb.Key(urlsafe=request.websafeSessionKey).get()
+        session = self._uow.get(ndb.Key(urlsafe=request.websafeSessionKey))
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.websafeSessionKey)
@@ -707,7 +1357,8 @@ class ConferenceApi(remote.Service):
 
         # delete from user profile's wishlist
         prof.sessKeyWishlist.remove(session.key)
-        prof.put()
+        self._uow.save(prof)
+        self._uow.flush()
 
         return self._copySessionToForm(session)
 
@@ -716,28 +1367,26 @@ class ConferenceApi(remote.Service):
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return profileToForm(prof)
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Tasklet version of _getProfileFromUser. Outside a transaction
+        the Profile is read once per request and a new one is saved by the
+        caller's flush; inside one it is read and put directly."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._currentUser()
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        # get Profile from the identity map or datastore
+        p_key = ndb.Key(Profile, self._currentUserId())
+        if ndb.in_transaction():
+            profile = yield p_key.get_async()
+        else:
+            profile = self._uow.get(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -746,9 +1395,12 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            if ndb.in_transaction():
+                yield profile.put_async()
+            else:
+                self._uow.save(profile)
 
-        return profile      # return Profile
+        raise ndb.Return(profile)      # return Profile
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
@@ -766,154 +1418,365 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        self._uow.save(prof)
+        # one write for a new and/or changed profile
+        self._uow.flush()
+        if save_request:
+            # organizer name is part of cached conference forms
+            bumpVersions(prof.key.urlsafe())
+            if save_request.displayName:
+                # and of followers' feeds
+                social.scheduleFanOut(prof.key.id())
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
 
 
+# - - - Social feed - - - - - - - - - - - - - - - - - - - - -
+
+    def _getFollowee(self, request):
+        """Return the Profile named by request.userId; bail if missing or
+        the current user."""
+        if request.userId == self._currentUserId():
+            raise endpoints.BadRequestException('You cannot follow yourself.')
+        followee = self._uow.get(ndb.Key(Profile, request.userId))
+        if not followee:
+            raise endpoints.NotFoundException(
+                'No profile found with user id: %s' % request.userId)
+        return followee
+
+    @endpoints.method(FOLLOW_REQUEST, BooleanMessage,
+            path='profile/follow/{userId}',
+            http_method='POST', name='followUser')
+    @instrumented
+    def followUser(self, request):
+        """Follow a user's conference registrations in the social feed."""
+        return BooleanMessage(data=social.follow(
+            self._currentUserId(), self._getFollowee(request)))
+
+    @endpoints.method(FOLLOW_REQUEST, BooleanMessage,
+            path='profile/follow/{userId}',
+            http_method='DELETE', name='unfollowUser')
+    @instrumented
+    def unfollowUser(self, request):
+        """Stop following a user."""
+        return BooleanMessage(data=social.unfollow(
+            self._currentUserId(), self._getFollowee(request)))
+
+    @endpoints.method(message_types.VoidMessage, SocialForms,
+            path='profile/feed',
+            http_method='GET', name='getSocialFeed')
+    @instrumented
+    def getSocialFeed(self, request):
+        """Return which followed users attend which conferences."""
+        # websafeConferenceKey is the latest registration
+        return SocialForms(socialList=[SocialForm(
+                displayName=entry.displayName,
+                conferenceKeysToAttend=[k.urlsafe() for k in entry.conferenceKeys],
+                websafeConferenceKey=entry.conferenceKeys[-1].urlsafe())
+            for entry in social.readFeed(self._currentUserId())])
+
+
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild nearly sold out set & Announcement from the datastore;
+        used by the reconciliation cron job and when memcache lost the set.
         """
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
 
-        if confs:
+        nearly_sold_out = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+        memcache.set(MEMCACHE_NEARLY_SOLD_OUT_KEY, nearly_sold_out)
+        return ConferenceApi._setAnnouncement(nearly_sold_out)
+
+    @staticmethod
+    def _setAnnouncement(nearly_sold_out):
+        """Format Announcement for the nearly sold out set & assign to memcache."""
+        if nearly_sold_out:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+                ', '.join(sorted(nearly_sold_out.values())))
+            localCache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         else:
             # If there are no sold out conferences,
             # delete the memcache announcements entry
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            localCache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
         return announcement
 
+    @staticmethod
+    def _noteSeatsAvailable(wsck, name, seats_left):
+        """Add or remove a conference from the nearly sold out set when its
+        seats cross the threshold; rebuilds Announcement on change."""
+        nearly = 0 < (seats_left or 0) <= NEARLY_SOLD_OUT_SEATS
+        client = memcache.Client()
+        for _ in range(CAS_RETRIES):
+            nearly_sold_out = client.gets(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+            if nearly_sold_out is None:
+                # evicted; rebuild from datastore, then apply our change
+                ConferenceApi._cacheAnnouncement()
+                continue
+            # most registrations don't cross the threshold
+            if nearly and nearly_sold_out.get(wsck) == name:
+                return
+            if not nearly and wsck not in nearly_sold_out:
+                return
+            nearly_sold_out = dict(nearly_sold_out)
+            if nearly:
+                nearly_sold_out[wsck] = name
+            else:
+                nearly_sold_out.pop(wsck, None)
+            if client.cas(MEMCACHE_NEARLY_SOLD_OUT_KEY, nearly_sold_out):
+                ConferenceApi._setAnnouncement(nearly_sold_out)
+                return
+        logging.warning('Could not update nearly sold out set for %s', wsck)
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=localCache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
 
-    # Sets a memcache key to speaker
     @staticmethod
-    def _setFeaturedSpeaker(featured_speaker, websafeConferenceKey):
-        # option 1
-        # sessions = Session.query(Session.speaker == featured_speaker,
-        #                          ancestor=ndb.Key(urlsafe=websafeConferenceKey))
+    def _featuredSpeakerKey(conf_key):
+        """FeaturedSpeaker key; shares the entity group of conf's sessions."""
+        return ndb.Key(FeaturedSpeaker, 'featured',
+                       parent=ndb.Key(Conference, conf_key.id()))
 
-        # option 2
-        # query filtering by speaker and confKey
-        sessions = Session.query(Session.speaker == featured_speaker)\
-                          .filter(Session.websafeConferenceKey == websafeConferenceKey)
+    @staticmethod
+    def _scheduleFeaturedSpeaker(websafeConferenceKey, speaker):
+        """Queue a featured speaker update for a conference. Updates are
+        coalesced into one named task per FEATURED_SPEAKER_WINDOW; the
+        latest speaker scheduled in the window is featured."""
+        memcache.set(MEMCACHE_FEATURED_CANDIDATE % websafeConferenceKey, speaker)
+        window = int(time.time()) // FEATURED_SPEAKER_WINDOW
+        try:
+            taskqueue.add(name='featured-%s-%d' % (websafeConferenceKey, window),
+                          params={'websafeConferenceKey': websafeConferenceKey},
+                          url='/tasks/set_featured_speaker',
+                          countdown=FEATURED_SPEAKER_WINDOW)
+            countEvent('featured_speaker_scheduled')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            countEvent('featured_speaker_coalesced')
+
+    # Sets a memcache key to speaker, per conference
+    @staticmethod
+    def _setFeaturedSpeaker(websafeConferenceKey, featured_speaker=None):
+        """Feature featured_speaker, else the latest scheduled candidate,
+        else the busiest speaker of the conference."""
+        countEvent('featured_speaker_runs')
+        # sessions are stored under a root Conference key with the same id,
+        # and indexed per speaker in SpeakerSessions
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        c_key = ndb.Key(Conference, conf_key.id())
+        featured_speaker = featured_speaker or memcache.get(
+            MEMCACHE_FEATURED_CANDIDATE % websafeConferenceKey)
+        idx = None
+        if featured_speaker:
+            idx = ndb.Key(SpeakerSessions, featured_speaker, parent=c_key).get()
+        if not idx:
+            # candidate lost to memcache eviction
+            idxs = SpeakerSessions.query(ancestor=c_key).fetch()
+            idx = max(idxs, key=lambda i: len(i.sessionKeys)) if idxs else None
+        if not idx or len(idx.sessionKeys) < 2:
+            return
+        featured_speaker = idx.speaker
 
         # use list comprehension to extract session names
-        spkr_sessions = [s.sessionName for s in sessions]
+        spkr_sessions = [s.sessionName for s in ndb.get_multi(idx.sessionKeys) if s]
 
         # format memcache message from global template var
         memcache_msg = FEATURED_SPEAKER_TPL % featured_speaker + ', '.join(spkr_sessions)
 
-        # # alt option for joining session names
-        # for sess in sessions:
-        #     memcache_msg += str(sess.sessionName) + ", "
+        # persist so the message survives memcache eviction
+        FeaturedSpeaker(key=ConferenceApi._featuredSpeakerKey(conf_key),
+                        speaker=featured_speaker,
+                        message=memcache_msg).put()
 
-        # Set memcache key
-        memcache.set(MEMCACHE_FEATURED_SPEAKER, memcache_msg)
+        # Set memcache keys; the global one is the most recent anywhere
+        # and versioned for the instance caches
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_CONF % websafeConferenceKey,
+                     memcache_msg)
+        localCache.set(MEMCACHE_FEATURED_SPEAKER, memcache_msg)
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='featuredspeaker/get',
             http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
-        """Return Featured Speaker from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_FEATURED_SPEAKER) or "")
+        """Return most recently Featured Speaker from memcache."""
+        return StringMessage(data=localCache.get(MEMCACHE_FEATURED_SPEAKER) or "")
+
+
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+            path='conference/{websafeConferenceKey}/featuredspeaker',
+            http_method='GET', name='getConferenceFeaturedSpeaker')
+    @instrumented
+    def getConferenceFeaturedSpeaker(self, request):
+        """Return Featured Speaker of a conference, from memcache or datastore."""
+        wsck = request.websafeConferenceKey
+        cache_key = MEMCACHE_FEATURED_SPEAKER_CONF % wsck
+        msg = memcache.get(cache_key)
+        if msg is None:
+            # evicted or never set; fall back to the stored entity
+            featured = self._featuredSpeakerKey(ndb.Key(urlsafe=wsck)).get()
+            msg = featured.message if featured else ""
+            memcache.set(cache_key, msg)
+        return StringMessage(data=msg)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get conference outside the transaction so seat writes never
+        # contend on the Conference entity group
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = self._uow.get(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        if not conf.seatShards:
+            conf = seats.ensureShards(conf.key)
+            self._uow.add(conf)
+
+        retval = self._registrationTxn(conf, reg)
+
+        # seat total changed; refresh cached and denormalized counts. The
+        # total must be current before the version bump lets getConference
+        # re-render, so only the sync task overlaps the seat count
+        if retval:
+            sync_rpc = seats.scheduleSyncAsync(conf.key)
+            seats_left = seats.adjustSeats(conf, -1 if reg else 1)
+            self._noteSeatsAvailable(wsck, conf.name, seats_left)
+            bumpVersions(wsck)
+            seats.waitSync(sync_rpc)
+        return BooleanMessage(data=retval)
+
+    @staticmethod
+    def _attendeeKey(conf_key, user_id):
+        return ndb.Key(ConferenceAttendee, '%s:%s' % (conf_key.urlsafe(), user_id))
+
+    @staticmethod
+    def _backfillAttendees(page_token=None):
+        """Index registrations of one page of profiles made before the
+        attendee index existed, and rewrite profiles still storing urlsafe
+        strings as keys; returns the next page token or None. Safe to
+        rerun."""
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            ATTENDEE_BACKFILL_PAGE, start_cursor=cursor)
+        attendees = [ConferenceAttendee(
+                        key=ConferenceApi._attendeeKey(c_key, prof.key.id()),
+                        conferenceKey=c_key, userId=prof.key.id())
+                     for prof in profiles
+                     for c_key in prof.conferenceKeysToAttend]
+        ndb.put_multi(attendees)
+        for prof in profiles:
+            if UrlsafeKeyProperty.storedUrlsafe(prof):
+                ConferenceApi._rewriteConferenceKeysTxn(prof.key)
+        return next_cursor.urlsafe() if more and next_cursor else None
+
+    @staticmethod
+    @ndb.transactional()
+    def _rewriteConferenceKeysTxn(p_key):
+        """Store a profile's urlsafe conference strings as keys, unless a
+        registration has rewritten it since it was read."""
+        prof = p_key.get()
+        if prof and UrlsafeKeyProperty.storedUrlsafe(prof):
+            prof.put()
+
+    @ndb.transactional(xg=True)
+    def _registrationTxn(self, conf, reg):
+        """Update Profile, one SeatShard and the attendee index atomically."""
+        retval = None
+        prof_future = self._getProfileFromUserAsync() # get user Profile
+        a_key = self._attendeeKey(conf.key, self._currentUserId())
 
         # register
         if reg:
+            # take a seat while the profile loads; raising below rolls
+            # the seat back with the rest of the transaction
+            seat_future = seats.takeSeatAsync(conf)
+            prof = prof_future.get_result()
+            took_seat = seat_future.get_result()
+
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.conferenceKeysToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
 
             # check if seats avail
-            if conf.seatsAvailable <= 0:
+            if not took_seat:
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user
+            prof.conferenceKeysToAttend.append(conf.key)
+            ConferenceAttendee(key=a_key, conferenceKey=conf.key,
+                               userId=prof.key.id()).put()
             retval = True
+            social.scheduleFanOut(prof.key.id(), transactional=True)
 
         # unregister
         else:
+            prof = prof_future.get_result()
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.conferenceKeysToAttend:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                prof.conferenceKeysToAttend.remove(conf.key)
+                seats.returnSeat(conf)
+                a_key.delete()
                 retval = True
+                social.scheduleFanOut(prof.key.id(), transactional=True)
             else:
                 retval = False
 
-        # write things back to the datastore & return
+        # write things back to the datastore & return; the identity map
+        # only sees the new profile once it is committed
         prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        ndb.get_context().call_on_commit(lambda: self._uow.add(prof))
+        return retval
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conferences = self._uow.getMulti(prof.conferenceKeysToAttend)
 
-        # get organizers
+        # get organizers; the user's own profile is not read again
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = self._uow.getMulti(organisers)
+        self._uow.flush()
 
         # put display names in a dict for easier fetching
         names = {}
@@ -926,9 +1789,39 @@ class ConferenceApi(remote.Service):
         )
 
 
+    @endpoints.method(ATTENDEE_GET_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @instrumented
+    def getConferenceAttendees(self, request):
+        """Return attendees of a conference, optionally one page at a time;
+        organizer only."""
+        user_id = self._currentUserId()
+        conf = self._uow.get(ndb.Key(urlsafe=request.websafeConferenceKey))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list attendees.')
+
+        # served by the built-in conferenceKey index
+        q = ConferenceAttendee.query(ConferenceAttendee.conferenceKey == conf.key)
+        attendees, next_token = self._fetchPage(
+            q, request.pageSize, request.pageToken)
+        profiles = self._uow.getMulti(
+            [ndb.Key(Profile, a.userId) for a in attendees])
+        return AttendeeForms(
+            items=[AttendeeForm(userId=a.userId,
+                                displayName=getattr(prof, 'displayName', None))
+                   for a, prof in zip(attendees, profiles)],
+            nextPageToken=next_token)
+
+
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -937,6 +1830,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -945,6 +1839,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -965,51 +1860,113 @@ class ConferenceApi(remote.Service):
 
 # - - - Other Query Functions - - - - - - - - - - - - - - - - - - - -
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(PAGE_GET_REQUEST, SessionForms,
                       path='sessions/past',
                       http_method='GET',
                       name='getPastSessions')
+    @instrumented
     def getPastSessions(self, request):
-        """Return sessions that have occurred in the past."""
-        # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        sessions = Session.query(Session.date < datetime.now()).fetch()
-        # return set of SessionForm objects for conference
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        """Return sessions that have occurred in the past, newest first,
+        one page at a time."""
+        page_size = MAX_PAGE_SIZE if request.pageSize is None else request.pageSize
+        self._checkPageSize(page_size)
+
+        # pageToken is "<date>:<offset>" of the next session to return
+        if request.pageToken:
+            try:
+                day, offset = request.pageToken.split(':')
+                day = datetime.strptime(day, "%Y-%m-%d").date()
+                offset = int(offset)
+            except ValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+            days = SessionDay.query(SessionDay.date <= day)
+        else:
+            offset = 0
+            days = SessionDay.query(SessionDay.date < datetime.now().date())
+
+        # walk day buckets backwards, gathering whole dates until their keys
+        # cover the page, and read them with one get_multi; only repeats if
+        # deleted sessions left the page short. Shards of a date are
+        # merged; ties sort by key so offsets are stable
+        by_date = itertools.groupby(days.order(-SessionDay.date),
+                                    key=lambda day: day.date)
+        page = []   # (date, offset within the date, session)
+        more = True
+        while more and len(page) < page_size:
+            dated = []
+            wanted = page_size - len(page)
+            more = False
+            for date, shards in by_date:
+                s_keys = list(set(s_key for day in shards for s_key in day.sessionKeys))
+                dated.append((date, s_keys, offset))
+                wanted -= len(s_keys) - offset
+                offset = 0
+                if wanted <= 0:
+                    more = True
+                    break
+            found = dict((s.key, s) for s in ndb.get_multi(
+                [s_key for _, s_keys, _ in dated for s_key in s_keys]) if s)
+            for date, s_keys, skip in dated:
+                day_sessions = sorted(
+                    (found[s_key] for s_key in s_keys if s_key in found),
+                    key=lambda s: (s.startTime, s.key.id()), reverse=True)
+                page += [(date, skip + i, session) for i, session
+                         in enumerate(day_sessions[skip:])]
+        page = page[:page_size]
+
+        next_token = None
+        if len(page) == page_size:
+            date, i, _ = page[-1]
+            next_token = '%s:%d' % (date.isoformat(), i + 1)
+        sessions = [session for _, _, session in page]
+
+        # return set of SessionForm objects
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
 
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='sessions/today',
                       http_method='GET',
                       name='getSessionsToday')
+    @instrumented
     def getSessionsToday(self, request):
         """Return sessions for today."""
-        # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        sessions = Session.query(Session.date == datetime.now()).fetch()
-        # return set of SessionForm objects for conference
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        today = datetime.now().date().isoformat()
+        cache_key = MEMCACHE_SESSIONS_DAY_KEY % today
+
+        # today's bucket is rendered once and reused until a session is
+        # added to it; tomorrow gets a new key
+        versions = getVersions([cache_key])
+        cached = memcache.get(cache_key)
+        if cached and cached[0] == versions:
+            return protojson.decode_message(SessionForms, cached[1])
+
+        days = ndb.get_multi(self._sessionDayKeys(datetime.now().date()))
+        s_keys = [s_key for day in days if day for s_key in day.sessionKeys]
+        sessions = [s for s in ndb.get_multi(s_keys) if s]
+        # return set of SessionForm objects for today
+        forms = SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        memcache.set(cache_key, (versions, protojson.encode_message(forms)),
+                     time=86400)
+        return forms
 
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='sessions/getSessionsByTypeTime',
                       http_method='GET', name='getSessionsByTypeTime')
+    @instrumented
     def getSessionsByTypeTime(self, request):
         """Returns all non workshop sessions held before 7 pm. """
-
-        sessions = Session.query(ndb.AND(
-                   Session.startTime != None,
-                   Session.startTime <= timed(hour=19)))
-
-        filtered_sessions = []
-        for session in sessions:
-            if 'workshop' == session.typeOfSession:
-                continue
-            else:
-                filtered_sessions.append(session)
+        # two inequalities; the planner pushes startTime, drops workshops
+        sessions, _ = self._runSessionQuery([
+            {'field': 'startTime', 'operator': '<=', 'value': timed(hour=19)},
+            {'field': 'typeOfSession', 'operator': '!=', 'value': 'workshop'},
+        ])
 
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in filtered_sessions]
+            items=[self._copySessionToForm(session) for session in sessions]
         )
 
 api = endpoints.api_server([ConferenceApi]) # register API
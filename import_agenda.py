@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""import_agenda.py -- offline loader for the bulk import endpoints
+
+Reads a JSON file holding a list of ConferenceForm or SessionForm objects
+and sends it to importConferences / importSessions in batches.
+
+    python import_agenda.py --token OAUTH_TOKEN conferences.json
+    python import_agenda.py --token OAUTH_TOKEN \\
+        --conference WEBSAFE_CONFERENCE_KEY agenda.json
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import argparse
+import json
+import sys
+import urllib2
+
+API_ROOT = 'https://conference-app-1144.appspot.com/_ah/api/conference/v1'
+BATCH_SIZE = 500    # MAX_IMPORT_SIZE in conference.py
+
+
+def post(url, token, items):
+    """POST one batch of forms, returning the created forms."""
+    req = urllib2.Request(url, json.dumps({'items': items}), {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer %s' % token,
+    })
+    return json.load(urllib2.urlopen(req)).get('items', [])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('file', help='JSON list of ConferenceForm/SessionForm')
+    parser.add_argument('--token', required=True, help='OAuth access token')
+    parser.add_argument('--conference',
+                        help='websafeConferenceKey; import sessions into it')
+    parser.add_argument('--api', default=API_ROOT, help='API root URL')
+    args = parser.parse_args(argv)
+
+    with open(args.file) as f:
+        items = json.load(f)
+
+    if args.conference:
+        url = '%s/conference/%s/sessions/import' % (args.api, args.conference)
+        key_field = 'websafeSessionKey'
+    else:
+        url = '%s/conferences/import' % args.api
+        key_field = 'websafeConferenceKey'
+
+    for i in range(0, len(items), BATCH_SIZE):
+        for form in post(url, args.token, items[i:i + BATCH_SIZE]):
+            print form.get(key_field)
+        sys.stderr.write('imported %d/%d\n' % (min(i + BATCH_SIZE, len(items)),
+                                               len(items)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""mailer.py
+
+Conference server-side Python App Engine batched confirmation email
+
+Confirmations go to the MAIL_QUEUE pull queue as one small JSON task per
+conference, tagged with the recipient. A cron worker leases them by tag,
+so each lease holds one recipient's confirmations, and mails them as one
+digest; a failed send is leased again after a backoff that doubles with
+every retry.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import json
+import logging
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+MAIL_QUEUE = 'confirmation-email'   # pull queue, see queue.yaml
+LEASE_SECONDS = 60
+LEASE_BATCH = 100           # tasks per lease; also the taskqueue maximum
+MAX_LEASES = 50             # recipients per worker run
+MAX_RETRIES = 8             # then the confirmation is dropped
+MAX_BACKOFF = 3600          # seconds
+
+MAIL_FIELDS = ('name', 'city', 'startDate', 'endDate', 'maxAttendees')
+CONFERENCE_TPL = u'%(name)s, %(city)s, %(startDate)s to %(endDate)s, %(maxAttendees)s seats'
+SUBJECT_ONE = 'You created a new Conference!'
+SUBJECT_MANY = 'You created %d new Conferences!'
+BODY_TPL = u'Hi, you have created the following %s:\r\n\r\n%s\r\n'
+
+
+def confirmationTask(email, form):
+    """Return the pull task confirming ConferenceForm form to email."""
+    payload = dict((field, getattr(form, field)) for field in MAIL_FIELDS)
+    payload['email'] = email
+    return taskqueue.Task(method='PULL', payload=json.dumps(payload),
+                          tag=email.encode('utf-8'))
+
+
+def queueConfirmationsAsync(email, forms):
+    """Start queueing confirmations of forms to email; returns the RPC."""
+    return taskqueue.Queue(MAIL_QUEUE).add_async(
+        [confirmationTask(email, form) for form in forms])
+
+
+def queueConfirmations(email, forms):
+    """Queue confirmations of forms to email, LEASE_BATCH per RPC."""
+    for i in range(0, len(forms), LEASE_BATCH):
+        queueConfirmationsAsync(email, forms[i:i + LEASE_BATCH]).get_result()
+
+
+def renderDigest(confs):
+    """Return (subject, body) confirming the conference payloads confs."""
+    lines = u'\r\n'.join(CONFERENCE_TPL % conf for conf in confs)
+    if len(confs) == 1:
+        return SUBJECT_ONE, BODY_TPL % ('conference', lines)
+    return (SUBJECT_MANY % len(confs),
+            BODY_TPL % ('%d conferences' % len(confs), lines))
+
+
+def _backoff(task):
+    return min(LEASE_SECONDS * 2 ** task.retry_count, MAX_BACKOFF)
+
+
+def sendConfirmations(send=mail.send_mail):
+    """Lease queued confirmations one recipient at a time and send each a
+    digest; returns the number of emails sent. send is the mail function,
+    e.g. a stub when testing."""
+    queue = taskqueue.Queue(MAIL_QUEUE)
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    sent = 0
+    for _ in range(MAX_LEASES):
+        # tasks sharing the tag of the oldest task, i.e. one recipient
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH)
+        if not tasks:
+            break
+        # untagged tasks lease together, so still group by payload
+        by_email = {}
+        for task in tasks:
+            conf = json.loads(task.payload)
+            by_email.setdefault(conf['email'], []).append((task, conf))
+
+        done = []
+        for email, items in by_email.items():
+            subject, body = renderDigest([conf for task, conf in items])
+            try:
+                send(sender, email, subject, body)
+                sent += 1
+                done += [task for task, conf in items]
+            except Exception:
+                logging.exception('Confirmation email to %s failed', email)
+                for task, conf in items:
+                    if task.retry_count >= MAX_RETRIES:
+                        logging.error('Dropping confirmation of %s to %s',
+                                      conf['name'], email)
+                        done.append(task)
+                    else:
+                        queue.modify_task_lease(task, _backoff(task))
+        if done:
+            queue.delete_tasks(done)
+    return sent
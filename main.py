@@ -12,10 +12,19 @@ created by mleafer on 2016 may 22
 
 __author__ = 'mariesleaf@gmail.com (Marie Leaf)'
 
+import json
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+import mailer
+import search
+import seats
+import social
+import stats
+import utils
 import logging
 logging.getLogger().setLevel(logging.DEBUG)
 
@@ -32,7 +41,8 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation; only drains push
+        tasks queued before confirmations moved to mailer."""
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -43,24 +53,102 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send queued confirmations as one digest per organizer."""
+        logging.info('Sent %d confirmation emails', mailer.sendConfirmations())
+        self.response.set_status(204)
+
 # https://github.com/apeabody/P4/blob/master/main.py
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
-    print '****MARKER FOR setfeaturedspeakerhandler TASKQUE CALL'
     def post(self):
-        """Check and Set Featured Speaker """
-        C_API = ConferenceApi()
-        featured_speaker = self.request.get('speaker')
+        """Check and Set Featured Speaker, once for every session added
+        to the conference in the last window"""
+        ConferenceApi._setFeaturedSpeaker(
+            self.request.get('websafeConferenceKey'),
+            self.request.get('speaker') or None)
+
+
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy sharded seat total onto the Conference."""
+        seats.syncSeatsAvailable(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class IndexSearchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Reindex Conferences or Sessions for keyword search."""
+        for key in self.request.get_all('key'):
+            search.indexDocument(ndb.Key(urlsafe=key))
+
+
+class FanOutAttendanceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a user's registrations into followers' social feeds."""
+        social.fanOut(self.request.get('userId'))
+
+
+class BackfillAttendeesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index one page of existing registrations, then queue the next."""
+        page_token = ConferenceApi._backfillAttendees(
+            self.request.get('pageToken') or None)
+        if page_token:
+            taskqueue.add(params={'pageToken': page_token},
+                          url='/tasks/backfill_attendees')
+
 
-        logging.debug(featured_speaker)
-        print featured_speaker
+class BackfillSpeakerSessionsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index one page of speakers' old session lists, then queue the
+        next."""
+        page_token = ConferenceApi._backfillSpeakerSessions(
+            self.request.get('pageToken') or None)
+        if page_token:
+            taskqueue.add(params={'pageToken': page_token},
+                          url='/tasks/backfill_speaker_sessions')
 
-        websafeConferenceKey = self.request.get('websafeConferenceKey')
 
-        C_API._setFeaturedSpeaker(featured_speaker, websafeConferenceKey)
+class BackfillSessionDaysHandler(webapp2.RequestHandler):
+    def post(self):
+        """List one page of existing sessions by day, then queue the next."""
+        page_token = ConferenceApi._backfillSessionDays(
+            self.request.get('pageToken') or None)
+        if page_token:
+            taskqueue.add(params={'pageToken': page_token},
+                          url='/tasks/backfill_session_days')
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return sampled per-endpoint stats as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'sampleRate': stats.SAMPLE_RATE,
+            'methods': stats.getStats(),
+            'events': stats.getEvents(),
+            # this instance only
+            'localCaches': dict((cache.name, cache.stats())
+                                for cache in utils.LOCAL_CACHES),
+        }, indent=2, sort_keys=True))
+
+    def delete(self):
+        """Reset the stats counters."""
+        stats.resetStats()
+        self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler)
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
+    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/index_search', IndexSearchHandler),
+    ('/tasks/fan_out_attendance', FanOutAttendanceHandler),
+    ('/tasks/backfill_attendees', BackfillAttendeesHandler),
+    ('/tasks/backfill_speaker_sessions', BackfillSpeakerSessionsHandler),
+    ('/tasks/backfill_session_days', BackfillSessionDaysHandler),
+    ('/admin/stats', StatsHandler)
 ], debug=True)
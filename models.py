@@ -35,6 +35,12 @@ class Session(ndb.Model):
     organizerUserId = ndb.StringProperty()
     websafeConferenceKey  = ndb.StringProperty()
 
+class SessionDay(ndb.Model):
+    """SessionDay -- keys of one shard of the sessions held on a date;
+    keyed by "<ISO date>:<shard>", see ConferenceApi._sessionDayKey"""
+    date        = ndb.DateProperty(required=True)
+    sessionKeys = ndb.KeyProperty(Session, repeated=True, indexed=False)
+
 # defines input parameters for _createSessionObject
 class SessionForm(messages.Message):
     """SessionForm -- Session outbound form message"""
@@ -52,6 +58,8 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2) # None on last page
+    truncated = messages.BooleanField(3) # search hit SEARCH_TOKEN_LIMIT
 
 
 class SessionQueryForm(messages.Message):
@@ -61,16 +69,41 @@ class SessionQueryForm(messages.Message):
     value = messages.StringField(3)
 
 class SessionQueryForms(messages.Message):
-    """ConferenceQueryForms -- multiple SessionQueryForm inbound form message"""
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
     filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3) # nextPageToken from previous page
+
+class UrlsafeKeyProperty(ndb.KeyProperty):
+    """KeyProperty that also loads keys stored as urlsafe strings, so
+    entities written before a StringProperty became a KeyProperty still
+    read; they are stored as keys on their next put"""
+    def _db_get_value(self, v, unused_p):
+        if v.has_stringvalue():
+            return ndb.Key(urlsafe=v.stringvalue())
+        return super(UrlsafeKeyProperty, self)._db_get_value(v, unused_p)
+
+    def _deserialize(self, entity, p, *args):
+        if p.value().has_stringvalue():
+            # remembered so backfills only rewrite entities that need it
+            entity._storedUrlsafe = True
+        return super(UrlsafeKeyProperty, self)._deserialize(entity, p, *args)
+
+    @staticmethod
+    def storedUrlsafe(entity):
+        """True if entity was loaded with keys stored as urlsafe strings."""
+        return getattr(entity, '_storedUrlsafe', False)
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # attendees of a conference are listed via ConferenceAttendee
+    conferenceKeysToAttend = UrlsafeKeyProperty(kind='Conference',
+                                                repeated=True, indexed=False)
     sessKeyWishlist = ndb.KeyProperty(Session, repeated=True)
+    celebrity = ndb.BooleanProperty(default=False, indexed=False) # feed read-side
 
 # only editable by users
 class ProfileMiniForm(messages.Message):
@@ -104,12 +137,36 @@ class Conference(ndb.Model):
     month           = ndb.IntegerProperty() # TODO: do we need for indexing like Java?
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
-    seatsAvailable  = ndb.IntegerProperty()
+    seatsAvailable  = ndb.IntegerProperty() # denormalized from SeatShards
+    seatShards      = ndb.IntegerProperty(indexed=False) # None until sharded
 
     @property
     def sessions(self):
         return Session.query(ancestor=self.key)
 
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's remaining seats; root entity
+    so registrations on different shards don't share an entity group"""
+    conferenceKey = ndb.KeyProperty(kind='Conference', required=True)
+    seats         = ndb.IntegerProperty(default=0, indexed=False)
+
+class ConferenceAttendee(ndb.Model):
+    """ConferenceAttendee -- one registration; root entity keyed by
+    "websafeConferenceKey:userId" so registrations for a big conference
+    never share an entity group"""
+    conferenceKey = ndb.KeyProperty(kind='Conference', required=True)
+    userId        = ndb.StringProperty(required=True, indexed=False)
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- conference attendee outbound form message"""
+    userId      = messages.StringField(1)
+    displayName = messages.StringField(2)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- multiple AttendeeForm outbound form message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2) # websafe cursor, None on last page
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -128,6 +185,9 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2) # websafe cursor, None on last page
+    queryPlan = messages.StringField(3) # filters pushed to datastore vs memory
+    truncated = messages.BooleanField(4) # search hit SEARCH_TOKEN_LIMIT
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -156,6 +216,27 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3) # nextPageToken from previous page
+
+class Follow(ndb.Model):
+    """Follow -- follower follows followee; root entity keyed by
+    followee and follower user ids joined with ':'"""
+    followee = ndb.StringProperty(required=True)
+    follower = ndb.StringProperty(required=True, indexed=False)
+
+class FeedEntry(ndb.Model):
+    """FeedEntry -- conferences one followed user attends"""
+    userId         = ndb.StringProperty(indexed=False)
+    displayName    = ndb.StringProperty(indexed=False)
+    conferenceKeys = ndb.KeyProperty(kind='Conference', repeated=True,
+                                     indexed=False)
+
+class SocialFeed(ndb.Model):
+    """SocialFeed -- a user's "friends attending" feed; keyed by user id.
+    Followed celebrities are not fanned out to it and are read on demand"""
+    entries     = ndb.LocalStructuredProperty(FeedEntry, repeated=True)
+    celebrities = ndb.StringProperty(repeated=True, indexed=False)
 
 class SocialForm(messages.Message):
     """ProfileFeedForm -- Social Feed inbound/outbound form message"""
@@ -172,8 +253,30 @@ class Speaker(ndb.Model):
     displayName = ndb.StringProperty(required=True)
     mainEmail = ndb.StringProperty(required=True)
     bio = ndb.TextProperty()
-    # sessionKeys = ndb.KeyProperty(Session, repeated=True)
-    sessionKeys = ndb.StringProperty(repeated=True)
+    # sessions are indexed per conference in SpeakerSessions
+
+class SpeakerSessions(ndb.Model):
+    """SpeakerSessions -- a speaker's sessions at one conference; keyed by
+    speaker name with the session's conference key as parent"""
+    speaker = ndb.StringProperty(required=True)
+    sessionKeys = ndb.KeyProperty(Session, repeated=True, indexed=False)
+
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- featured speaker message of one conference"""
+    speaker = ndb.StringProperty(required=True)
+    message = ndb.TextProperty()
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- one token of one indexed entity; key name is
+    "kind:token:websafeKey" so prefixes can be range scanned"""
+    doc    = ndb.KeyProperty(indexed=False)
+    weight = ndb.IntegerProperty(indexed=False)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- tokens currently indexed for an entity; keyed by
+    its websafe key"""
+    tokens  = ndb.StringProperty(repeated=True, indexed=False)
+    weights = ndb.IntegerProperty(repeated=True, indexed=False)
 
 class SpeakerForm(messages.Message):
     """SpeakerForm -- Speaker outbound form message"""
@@ -188,4 +291,5 @@ class SpeakerMiniForm(messages.Message):
     mainEmail = messages.StringField(2)
 
 class SpeakerList(messages.Message):
-    items = messages.MessageField(SpeakerMiniForm, 1, repeated=True)
\ No newline at end of file
+    items = messages.MessageField(SpeakerMiniForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2) # None on last page
\ No newline at end of file
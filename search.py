@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""search.py
+
+Conference server-side Python App Engine keyword search
+
+Inverted index of Conference and Session text. Each (kind, token, entity)
+is one SearchPosting whose key name starts with "kind:token:", so exact and
+prefix lookups are both a __key__ range scan on the built-in key index.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import re
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+from models import SearchPosting
+
+# indexed fields and their ranking weight, per kind
+SEARCH_FIELDS = {
+    'Conference': {'name': 3, 'topics': 2, 'description': 1},
+    'Session': {'sessionName': 3, 'highlights': 2},
+}
+MIN_TOKEN_LENGTH = 2
+SEARCH_TOKEN_LIMIT = 1000   # postings read per query token
+INDEX_TASK_KEYS = 100       # entities reindexed per task by bulk imports
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lowercase index tokens of text."""
+    return [t for t in TOKEN_RE.findall((text or u'').lower())
+            if len(t) >= MIN_TOKEN_LENGTH]
+
+
+def _documentTokens(doc):
+    """Return dict of token -> summed field weight for an entity."""
+    tokens = {}
+    for field, weight in SEARCH_FIELDS[doc.key.kind()].items():
+        value = getattr(doc, field)
+        for text in (value if isinstance(value, list) else [value]):
+            for token in set(tokenize(text)):
+                tokens[token] = tokens.get(token, 0) + weight
+    return tokens
+
+
+def _postingKey(kind, token, doc_key):
+    return ndb.Key(SearchPosting, u'%s:%s:%s' % (kind, token, doc_key.urlsafe()))
+
+
+def indexTask(doc_key):
+    """Return the task that (re)indexes an entity."""
+    return taskqueue.Task(params={'key': doc_key.urlsafe()},
+                          url='/tasks/index_search')
+
+
+def scheduleIndex(doc_key, transactional=False):
+    """Queue (re)indexing of an entity; pass transactional=True inside a
+    transaction so the index only changes if the write commits."""
+    taskqueue.Queue().add(indexTask(doc_key), transactional=transactional)
+
+
+def scheduleIndexMulti(doc_keys):
+    """Queue reindexing of many entities, INDEX_TASK_KEYS per task."""
+    websafe = [doc_key.urlsafe() for doc_key in doc_keys]
+    tasks = [taskqueue.Task(params={'key': websafe[i:i + INDEX_TASK_KEYS]},
+                            url='/tasks/index_search')
+             for i in range(0, len(websafe), INDEX_TASK_KEYS)]
+    if tasks:
+        taskqueue.Queue().add(tasks)
+
+
+def indexDocument(doc_key):
+    """Bring the postings of an entity in line with its current text;
+    removes them all if the entity was deleted."""
+    kind = doc_key.kind()
+    doc = doc_key.get()
+    tokens = _documentTokens(doc) if doc else {}
+
+    sdoc_key = ndb.Key(SearchDocument, doc_key.urlsafe())
+    sdoc = sdoc_key.get()
+    old = dict(zip(sdoc.tokens, sdoc.weights)) if sdoc else {}
+
+    # only touch postings that appeared, vanished or changed weight
+    ndb.delete_multi([_postingKey(kind, t, doc_key)
+                      for t in old if t not in tokens])
+    ndb.put_multi([SearchPosting(key=_postingKey(kind, t, doc_key),
+                                 doc=doc_key, weight=w)
+                   for t, w in tokens.items() if old.get(t) != w])
+    if tokens:
+        SearchDocument(key=sdoc_key, tokens=tokens.keys(),
+                       weights=tokens.values()).put()
+    elif sdoc:
+        sdoc_key.delete()
+
+
+def search(kind, text):
+    """Return (keys, truncated): keys of kind matching every word of text
+    as a token prefix, best match first. Score is the sum of each word's
+    best field weight. Only the first SEARCH_TOKEN_LIMIT postings of a
+    word are read, in key order; truncated is True if a word had more, so
+    matches may be missing."""
+    words = sorted(set(tokenize(text)))
+    if not words:
+        return [], False
+
+    # one key range scan per word, run in parallel
+    futures = []
+    for word in words:
+        lo = u'%s:%s' % (kind, word)
+        futures.append(SearchPosting.query(
+            SearchPosting.key >= ndb.Key(SearchPosting, lo),
+            SearchPosting.key < ndb.Key(SearchPosting, lo + u'\ufffd'),
+        ).fetch_async(SEARCH_TOKEN_LIMIT + 1))
+
+    scores = None
+    truncated = False
+    for future in futures:
+        postings = future.get_result()
+        if len(postings) > SEARCH_TOKEN_LIMIT:
+            truncated = True
+            postings = postings[:SEARCH_TOKEN_LIMIT]
+        best = {}
+        for posting in postings:
+            best[posting.doc] = max(best.get(posting.doc, 0), posting.weight)
+        if scores is None:
+            scores = best
+        else:
+            # every word has to match
+            scores = dict((k, scores[k] + w) for k, w in best.items()
+                          if k in scores)
+    return sorted(scores, key=lambda k: (-scores[k], k.urlsafe())), truncated
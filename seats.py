@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Conference server-side Python App Engine sharded seat counters
+
+Remaining seats of a conference are split over SeatShard root entities so
+concurrent registrations land in different entity groups. Each shard only
+ever hands out its own slice, so the conference can never be oversold.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+from utils import bumpVersions
+
+NUM_SEAT_SHARDS = 20    # xg transactions are limited to 25 entity groups
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE_%s"
+SEATS_CACHE_TIME = 30   # seconds
+SYNC_WINDOW = 10        # seconds between Conference.seatsAvailable writes
+
+
+def shardKeys(conf):
+    """Return the SeatShard keys of a sharded conference."""
+    prefix = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (prefix, i))
+            for i in range(conf.seatShards or 0)]
+
+
+def _split(seats, num_shards):
+    """Spread seats over num_shards as evenly as possible."""
+    base, extra = divmod(seats, num_shards)
+    return [base + (1 if i < extra else 0) for i in range(num_shards)]
+
+
+def newShards(conf):
+    """Shard conf.seatsAvailable; returns unsaved SeatShards and sets
+    conf.seatShards, so caller must put both."""
+    seats = max(conf.seatsAvailable or 0, 0)
+    conf.seatShards = max(1, min(NUM_SEAT_SHARDS, seats))
+    return [SeatShard(key=key, conferenceKey=conf.key, seats=n)
+            for key, n in zip(shardKeys(conf), _split(seats, conf.seatShards))]
+
+
+@ndb.transactional(xg=True)
+def ensureShards(conf_key):
+    """Shard a conference created before seat sharding; returns it."""
+    conf = conf_key.get()
+    if conf and not conf.seatShards:
+        ndb.put_multi(newShards(conf) + [conf])
+    return conf
+
+
+@ndb.tasklet
+def takeSeatAsync(conf):
+    """Take one seat from a random shard, trying the others if it is
+    empty. Must run in a transaction; the future's result is False when
+    sold out."""
+    keys = shardKeys(conf)
+    random.shuffle(keys)
+    shard = yield keys[0].get_async()
+    if not shard or shard.seats <= 0:
+        # first pick is empty, look at the rest in one batch
+        shard = None
+        for candidate in (yield ndb.get_multi_async(keys[1:])):
+            if candidate and candidate.seats > 0:
+                shard = candidate
+                break
+    if not shard:
+        raise ndb.Return(False)
+    shard.seats -= 1
+    yield shard.put_async()
+    raise ndb.Return(True)
+
+
+def takeSeat(conf):
+    """Synchronous takeSeatAsync."""
+    return takeSeatAsync(conf).get_result()
+
+
+def returnSeat(conf):
+    """Give one seat back to a random shard; must run in a transaction."""
+    key = random.choice(shardKeys(conf))
+    shard = key.get() or SeatShard(key=key, conferenceKey=conf.key)
+    shard.seats += 1
+    shard.put()
+
+
+def resize(conf, delta):
+    """Add (delta > 0) or remove (delta < 0) seats across the shards;
+    must run in a transaction. Seats already taken are never revoked."""
+    keys = shardKeys(conf)
+    shards = [shard or SeatShard(key=key, conferenceKey=conf.key)
+              for key, shard in zip(keys, ndb.get_multi(keys))]
+    if delta >= 0:
+        for shard, n in zip(shards, _split(delta, len(shards))):
+            shard.seats += n
+    else:
+        remaining = -delta
+        for shard in shards:
+            n = min(shard.seats, remaining)
+            shard.seats -= n
+            remaining -= n
+    ndb.put_multi(shards)
+
+
+def seatsAvailable(conf):
+    """Return remaining seats summed over the shards, cached in memcache."""
+    if not conf.seatShards:
+        return conf.seatsAvailable
+    cache_key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    seats = memcache.get(cache_key)
+    if seats is None:
+        seats = sum(s.seats for s in ndb.get_multi(shardKeys(conf)) if s)
+        memcache.set(cache_key, seats, time=SEATS_CACHE_TIME)
+    return seats
+
+
+def adjustSeats(conf, delta):
+    """Apply a committed seat change to the cached total; returns the
+    new total, recounting the shards if it was not cached."""
+    cache_key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    if delta < 0:
+        seats = memcache.decr(cache_key, -delta)
+    else:
+        seats = memcache.incr(cache_key, delta)
+    if seats is None:
+        seats = seatsAvailable(conf)
+    return seats
+
+
+def flushSeats(conf_key):
+    """Drop the cached seat total so the next read recounts the shards."""
+    memcache.delete(MEMCACHE_SEATS_KEY % conf_key.urlsafe())
+
+
+def scheduleSyncAsync(conf_key):
+    """Copy the shard total back onto Conference.seatsAvailable at most
+    once per SYNC_WINDOW; the task name dedupes registrations in a window.
+    Returns an RPC to finish with waitSync."""
+    window = int(time.time()) // SYNC_WINDOW
+    return taskqueue.Queue().add_async(taskqueue.Task(
+        name='seats-%s-%d' % (conf_key.urlsafe(), window),
+        params={'websafeConferenceKey': conf_key.urlsafe()},
+        url='/tasks/sync_seats_available',
+        countdown=SYNC_WINDOW))
+
+
+def waitSync(rpc):
+    """Wait for scheduleSyncAsync; a sync already queued is fine."""
+    try:
+        rpc.get_result()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def scheduleSync(conf_key):
+    """Synchronous scheduleSyncAsync."""
+    waitSync(scheduleSyncAsync(conf_key))
+
+
+@ndb.transactional()
+def _storeSeatsAvailable(conf_key, seats):
+    conf = conf_key.get()
+    if conf and conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        conf.put()
+
+
+def syncSeatsAvailable(conf_key):
+    """Recompute the shard total and store it on the Conference; drops
+    cached forms, which may show a drifted total."""
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return
+    flushSeats(conf_key)
+    _storeSeatsAvailable(conf_key, seatsAvailable(conf))
+    bumpVersions(conf_key.urlsafe())
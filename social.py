@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""social.py
+
+Conference server-side Python App Engine "friends attending" feed
+
+When a user's registrations change, a task copies them into the SocialFeed
+of each follower (fan-out on write), so reading a feed is one keyed get.
+Users with more than CELEBRITY_FOLLOWERS followers are not fanned out;
+their followers' feeds list them and their profiles are read on demand.
+A feed keeps the MAX_FEED_ENTRIES most recently changed users.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import FeedEntry
+from models import Follow
+from models import Profile
+from models import SocialFeed
+
+CELEBRITY_FOLLOWERS = 1000  # above this, followers read instead
+FAN_OUT_BATCH = 100         # feeds updated in parallel
+MAX_FEED_ENTRIES = 200      # per feed, keeps it well under the 1MB entity limit
+
+
+def _followKey(followee_id, follower_id):
+    return ndb.Key(Follow, '%s:%s' % (followee_id, follower_id))
+
+
+def _entry(prof):
+    return FeedEntry(userId=prof.key.id(), displayName=prof.displayName,
+                     conferenceKeys=prof.conferenceKeysToAttend)
+
+
+@ndb.transactional_tasklet
+def _updateFeedAsync(follower_id, prof, celebrity, remove=False):
+    """Bring prof's part of one follower's feed up to date."""
+    key = ndb.Key(SocialFeed, follower_id)
+    feed = (yield key.get_async()) or SocialFeed(key=key)
+    user_id = prof.key.id()
+    feed.entries = [e for e in feed.entries if e.userId != user_id]
+    if user_id in feed.celebrities:
+        feed.celebrities.remove(user_id)
+    if not remove:
+        if celebrity:
+            feed.celebrities.append(user_id)
+        elif prof.conferenceKeysToAttend:
+            # most recently changed first; the oldest fall off the end
+            feed.entries.insert(0, _entry(prof))
+            del feed.entries[MAX_FEED_ENTRIES:]
+    yield feed.put_async()
+
+
+def follow(follower_id, followee):
+    """Follow the followee Profile; returns False if already following."""
+    key = _followKey(followee.key.id(), follower_id)
+    if key.get():
+        return False
+    Follow(key=key, followee=followee.key.id(), follower=follower_id).put()
+    _updateFeedAsync(follower_id, followee, followee.celebrity).get_result()
+    return True
+
+
+def unfollow(follower_id, followee):
+    """Stop following the followee Profile; returns False if not following."""
+    key = _followKey(followee.key.id(), follower_id)
+    if not key.get():
+        return False
+    key.delete()
+    _updateFeedAsync(follower_id, followee, False, remove=True).get_result()
+    return True
+
+
+def scheduleFanOut(user_id, transactional=False):
+    """Queue copying a user's registrations to their followers' feeds."""
+    taskqueue.add(params={'userId': user_id}, url='/tasks/fan_out_attendance',
+                  transactional=transactional)
+
+
+def _waitAll(futures):
+    """Wait for feed updates, raising on a failed one so the task is
+    retried; updates are idempotent."""
+    for future in futures:
+        future.get_result()
+
+
+def fanOut(user_id):
+    """Copy a user's registrations to each follower's feed. Past
+    CELEBRITY_FOLLOWERS the user is marked a celebrity, once more fanned
+    out as such, and skipped from then on."""
+    prof = ndb.Key(Profile, user_id).get()
+    if not prof or prof.celebrity:
+        return
+    q = Follow.query(Follow.followee == user_id)
+    celebrity = q.count(limit=CELEBRITY_FOLLOWERS + 1) > CELEBRITY_FOLLOWERS
+    futures = []
+    for f in q.iter(batch_size=FAN_OUT_BATCH):
+        futures.append(_updateFeedAsync(f.follower, prof, celebrity))
+        if len(futures) >= FAN_OUT_BATCH:
+            _waitAll(futures)
+            futures = []
+    _waitAll(futures)
+    if celebrity:
+        _markCelebrity(prof.key)
+
+
+@ndb.transactional()
+def _markCelebrity(p_key):
+    prof = p_key.get()
+    prof.celebrity = True
+    prof.put()
+
+
+def readFeed(user_id):
+    """Return the FeedEntries of a user's feed, fanned-out entries first;
+    one keyed get plus one get_multi for followed celebrities."""
+    feed = ndb.Key(SocialFeed, user_id).get()
+    if not feed:
+        return []
+    celebrities = ndb.get_multi([ndb.Key(Profile, uid)
+                                 for uid in feed.celebrities])
+    return feed.entries + [_entry(prof) for prof in celebrities
+                           if prof and prof.conferenceKeysToAttend]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Conference server-side Python App Engine endpoint instrumentation
+
+@instrumented records, for a sample of calls of each endpoint method, a
+latency histogram, API RPC counts by service and request/response sizes.
+Counters live in memcache so every instance adds to the same totals;
+read them with getStats (served at /admin/stats). Unsampled calls only
+pay for one random() and a thread-local lookup per RPC. countEvent keeps
+named counters for background work, read with getEvents.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import functools
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from protorpc import protojson
+
+# fraction of calls recorded; 0 turns instrumentation off
+SAMPLE_RATE = float(os.getenv('STATS_SAMPLE_RATE', '0.1'))
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]  # ms
+RPC_SERVICES = ['datastore_v3', 'memcache', 'taskqueue', 'urlfetch', 'mail']
+MEMCACHE_STATS_KEY = "STATS_%s_%s"
+MEMCACHE_EVENT_KEY = "STATS_EVENT_%s"
+EVENTS = ['featured_speaker_scheduled', 'featured_speaker_coalesced',
+          'featured_speaker_runs']
+
+METHODS = []    # names of instrumented methods, for getStats
+_state = threading.local()
+
+
+def _countRpc(service, call, request, response):
+    counts = getattr(_state, 'counts', None)
+    if counts is not None:
+        counts[service] = counts.get(service, 0) + 1
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('stats', _countRpc)
+
+
+def _bucket(ms):
+    for limit in LATENCY_BUCKETS:
+        if ms <= limit:
+            return 'le%d' % limit
+    return 'inf'
+
+
+def _size(message):
+    try:
+        return len(protojson.encode_message(message))
+    except Exception:
+        return 0
+
+
+def instrumented(func):
+    """Record a sample of calls of an endpoint method; apply it under
+    @endpoints.method."""
+    METHODS.append(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if not SAMPLE_RATE or random.random() >= SAMPLE_RATE:
+            return func(self, request)
+        _state.counts = counts = {}
+        start = time.time()
+        try:
+            response = func(self, request)
+        finally:
+            _state.counts = None
+        ms = (time.time() - start) * 1000
+        offsets = {'calls': 1, 'ms': int(ms), _bucket(ms): 1,
+                   'request_bytes': _size(request),
+                   'response_bytes': _size(response)}
+        for service, n in counts.items():
+            offsets['rpc_' + service] = n
+        memcache.offset_multi(dict(
+            (MEMCACHE_STATS_KEY % (func.__name__, field), n)
+            for field, n in offsets.items()), initial_value=0)
+        return response
+    return wrapper
+
+
+def _fields():
+    return (['calls', 'ms', 'request_bytes', 'response_bytes'] +
+            ['le%d' % limit for limit in LATENCY_BUCKETS] + ['inf'] +
+            ['rpc_' + service for service in RPC_SERVICES])
+
+
+def getStats():
+    """Return {method: {field: total}} for sampled calls so far; divide by
+    'calls' for per-call averages."""
+    fields = _fields()
+    keys = [MEMCACHE_STATS_KEY % (name, field)
+            for name in METHODS for field in fields]
+    values = memcache.get_multi(keys)
+    stats = {}
+    for name in METHODS:
+        counters = dict((field, values.get(MEMCACHE_STATS_KEY % (name, field), 0))
+                        for field in fields)
+        if counters['calls']:
+            stats[name] = counters
+    return stats
+
+
+def countEvent(name, n=1):
+    """Add n to the event counter name; name must be in EVENTS."""
+    memcache.incr(MEMCACHE_EVENT_KEY % name, n, initial_value=0)
+
+
+def getEvents():
+    """Return {event: count} of every counter in EVENTS."""
+    values = memcache.get_multi([MEMCACHE_EVENT_KEY % name for name in EVENTS])
+    return dict((name, values.get(MEMCACHE_EVENT_KEY % name, 0))
+                for name in EVENTS)
+
+
+def resetStats():
+    memcache.delete_multi([MEMCACHE_STATS_KEY % (name, field)
+                           for name in METHODS for field in _fields()] +
+                          [MEMCACHE_EVENT_KEY % name for name in EVENTS])
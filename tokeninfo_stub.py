@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""tokeninfo_stub.py -- local stand-in for the Google tokeninfo service
+
+Answers GET /?id_token=T or /?access_token=T like oauth2/v1/tokeninfo:
+tokens starting with "user" are valid and belong to a user id equal to the
+token, anything else is an invalid_token. Point the dev server at it to
+measure getUserId cache hit rate and latency offline:
+
+    python tokeninfo_stub.py --port 8089 --latency 0.2
+    TOKENINFO_URL=http://localhost:8089/ dev_appserver.py .
+
+Every lookup is logged, so the number of lines is the number of misses.
+
+created by mleafer on 2016 jun 02
+
+"""
+
+__author__ = 'mariesleaf@gmail.com (Marie Leaf)'
+
+import argparse
+import BaseHTTPServer
+import json
+import sys
+import time
+import urlparse
+
+
+class TokenInfoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    latency = 0
+    expires_in = 3600
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        token = (query.get('id_token') or query.get('access_token') or [''])[0]
+        if token.startswith('user'):
+            status, body = 200, {'user_id': token, 'expires_in': self.expires_in}
+        else:
+            status, body = 400, {'error': 'invalid_token'}
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each reply')
+    parser.add_argument('--expires-in', type=int, default=3600,
+                        help='expires_in reported for valid tokens')
+    args = parser.parse_args(argv)
+
+    TokenInfoHandler.latency = args.latency
+    TokenInfoHandler.expires_in = args.expires_in
+    BaseHTTPServer.HTTPServer(('', args.port), TokenInfoHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,29 @@
+import collections
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
+# tokeninfo endpoint; point at tokeninfo_stub.py to run offline
+TOKENINFO_URL = os.getenv('TOKENINFO_URL',
+                          'https://www.googleapis.com/oauth2/v1/tokeninfo')
+TOKENINFO_DEADLINE = 2      # seconds per tokeninfo fetch; never retried inline
+MEMCACHE_TOKEN_KEY = "TOKEN_%s"
+TOKEN_CACHE_SIZE = 1000     # tokens kept per instance
+TOKEN_CACHE_TIME = 3600     # seconds; never past the token's own expiry
+INVALID_TOKEN_CACHE_TIME = 60
+
+_token_cache = collections.OrderedDict()   # token hash -> (user_id, expiry)
+_token_lock = threading.Lock()
+TOKEN_CACHE_STATS = collections.Counter()  # local/memcache hits, fetches
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -14,25 +32,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getTokenUserId(token)
 
     if id_type == "custom":
         # this is just a sample that queries datastore for an existing profile
@@ -42,3 +42,240 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def _tokenCacheGet(digest):
+    with _token_lock:
+        entry = _token_cache.pop(digest, None)
+        if entry and entry[1] > time.time():
+            # reinsert as most recently used
+            _token_cache[digest] = entry
+            return entry[0]
+
+def _tokenCacheSet(digest, user_id, ttl):
+    with _token_lock:
+        _token_cache.pop(digest, None)
+        _token_cache[digest] = (user_id, time.time() + ttl)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+def getTokenUserId(token):
+    """Return the user id an OAuth token belongs to, '' if it is invalid.
+
+    Answers come from an in-process LRU, then memcache, then tokeninfo.
+    Valid tokens are cached until they expire (at most TOKEN_CACHE_TIME)
+    and invalid ones for INVALID_TOKEN_CACHE_TIME. Keys are a hash so
+    tokens never sit in memcache in the clear.
+    """
+    digest = hashlib.sha1(token).hexdigest()
+    user_id = _tokenCacheGet(digest)
+    if user_id is not None:
+        TOKEN_CACHE_STATS['local'] += 1
+        return user_id
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % digest)
+    if cached is not None:
+        TOKEN_CACHE_STATS['memcache'] += 1
+        user_id, expiry = cached
+        _tokenCacheSet(digest, user_id, expiry - time.time())
+        return user_id
+
+    TOKEN_CACHE_STATS['fetch'] += 1
+    info = _fetchTokenInfoAsync(token).get_result()
+    if info is None:
+        # tokeninfo unavailable; don't cache, the token may be fine
+        return ''
+    user_id = info.get('user_id', '')
+    if user_id:
+        ttl = min(int(info.get('expires_in', TOKEN_CACHE_TIME)),
+                  TOKEN_CACHE_TIME)
+    else:
+        ttl = INVALID_TOKEN_CACHE_TIME
+    if ttl > 0:
+        memcache.set(MEMCACHE_TOKEN_KEY % digest,
+                     (user_id, time.time() + ttl), time=ttl)
+        _tokenCacheSet(digest, user_id, ttl)
+    return user_id
+
+@ndb.tasklet
+def _fetchTokenInfoAsync(token):
+    """Look token up at tokeninfo, trying it as an id_token first (an
+    access_token if OAUTH_USER_ID is set) and then as an access_token.
+
+    Result is the decoded reply, {} for an invalid token or None if
+    tokeninfo failed. Failures are not retried here, so a miss waits for
+    at most one TOKENINFO_DEADLINE per token type; getTokenUserId caches
+    nothing for them and the client's next request tries again.
+    """
+    token_types = ['id_token', 'access_token']
+    if 'OAUTH_USER_ID' in os.environ:
+        token_types = ['access_token']
+    ctx = ndb.get_context()
+    for token_type in token_types:
+        url = '%s?%s=%s' % (TOKENINFO_URL, token_type, token)
+        try:
+            resp = yield ctx.urlfetch(url, deadline=TOKENINFO_DEADLINE)
+        except urlfetch.Error:
+            raise ndb.Return(None)
+        if resp.status_code == 200:
+            raise ndb.Return(json.loads(resp.content))
+        if resp.status_code != 400 or 'invalid_token' not in resp.content:
+            raise ndb.Return(None)
+    raise ndb.Return({})
+
+
+def compileCopyPlan(model, message, convert=None, keyField=None):
+    """Return a function copying a `model` entity into a new `message`.
+
+    The fields the two classes share are resolved once, here, instead of
+    per entity with hasattr/getattr reflection. `convert` maps a field name
+    to a function applied to the entity value (e.g. str for dates) and
+    `keyField` names the message field that gets entity.key.urlsafe().
+    """
+    convert = convert or {}
+    fields = [field for field in message.all_fields()
+              if field.name in model._properties]
+    plain = tuple(f.name for f in fields if f.name not in convert)
+    converted = tuple((f.name, convert[f.name]) for f in fields
+                      if f.name in convert)
+    # none of our forms have required fields; only check if one does
+    check = any(f.required for f in message.all_fields())
+
+    def copy(entity):
+        msg = message()
+        for name in plain:
+            setattr(msg, name, getattr(entity, name))
+        for name, func in converted:
+            setattr(msg, name, func(getattr(entity, name)))
+        if keyField:
+            setattr(msg, keyField, entity.key.urlsafe())
+        if check:
+            msg.check_initialized()
+        return msg
+    return copy
+
+
+MEMCACHE_VERSION_KEY = "VERSION_%s"
+
+def getVersions(names):
+    """Return the current memcache version stamp of each name as a tuple.
+
+    Cache entries store the stamp of everything they were rendered from and
+    are only used while it still matches; writers call bumpVersions. Stamps
+    missing from memcache start at the current time in ms, so they are
+    still newer than any stamp lost to eviction.
+    """
+    keys = [MEMCACHE_VERSION_KEY % name for name in names]
+    versions = memcache.get_multi(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = int(time.time() * 1000)
+        memcache.add_multi(dict((key, now) for key in missing))
+        versions.update(memcache.get_multi(missing))
+    return tuple(versions.get(key) for key in keys)
+
+def bumpVersionsAsync(*names):
+    """Start invalidating cache entries stamped with any of names;
+    returns the memcache RPC."""
+    return memcache.Client().offset_multi_async(
+        dict((MEMCACHE_VERSION_KEY % name, 1) for name in names),
+        initial_value=int(time.time() * 1000))
+
+def bumpVersions(*names):
+    """Invalidate cache entries stamped with any of names."""
+    bumpVersionsAsync(*names).get_result()
+
+
+class UnitOfWork(object):
+    """Request-scoped identity map of datastore entities.
+
+    get/getMulti read each key at most once per request and hand back the
+    same object every time; save marks an entity dirty and flush writes
+    all dirty entities in one put_multi. Inside a transaction reads go to
+    the datastore so they are part of it.
+    """
+
+    def __init__(self):
+        self._entities = {}
+        self._dirty = collections.OrderedDict()
+
+    def getMulti(self, keys):
+        if ndb.in_transaction():
+            return ndb.get_multi(keys)
+        missing = list(collections.OrderedDict.fromkeys(
+            key for key in keys if key not in self._entities))
+        if missing:
+            self._entities.update(zip(missing, ndb.get_multi(missing)))
+        return [self._entities[key] for key in keys]
+
+    def get(self, key):
+        return self.getMulti([key])[0]
+
+    def add(self, entity):
+        """Remember an entity read or written elsewhere, e.g. in a
+        transaction that has committed."""
+        self._entities[entity.key] = entity
+
+    def save(self, entity):
+        """Queue entity for the next flush."""
+        self.add(entity)
+        self._dirty[entity.key] = entity
+
+    def flush(self):
+        """Write every entity saved since the last flush."""
+        if self._dirty:
+            ndb.put_multi(self._dirty.values())
+            self._dirty.clear()
+
+
+LOCAL_CACHES = []   # every LocalCache of this instance, for stats
+
+class LocalCache(object):
+    """Per-instance TTL cache in front of hot, read-mostly memcache keys.
+
+    get serves a key from instance memory for up to ttl seconds. After that
+    it rechecks the key's version stamp (see bumpVersions) and only reloads
+    the value if the stamp moved. set and delete write memcache, bump the
+    stamp and update this instance at once; other instances see the change
+    within ttl. Hits and misses are counted per key.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self._entries = {}      # key -> (value, version, expiry)
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        LOCAL_CACHES.append(self)
+
+    def get(self, key):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry and entry[2] > now:
+            self.hits[key] += 1
+            return entry[0]
+        self.misses[key] += 1
+        version = memcache.get(MEMCACHE_VERSION_KEY % key)
+        if entry and version is not None and version == entry[1]:
+            value = entry[0]
+        else:
+            value = memcache.get(key)
+        self._entries[key] = (value, version, now + self.ttl)
+        return value
+
+    def set(self, key, value, expires=0):
+        memcache.set(key, value, time=expires)
+        self._changed(key, value)
+
+    def delete(self, key):
+        memcache.delete(key)
+        self._changed(key, None)
+
+    def _changed(self, key, value):
+        bumpVersions(key)
+        # stamp unknown here; the next recheck reloads the value once
+        self._entries[key] = (value, None, time.time() + self.ttl)
+
+    def stats(self):
+        """Return {key: {'hits': n, 'misses': n}} for this instance."""
+        return dict((key, {'hits': self.hits[key], 'misses': self.misses[key]})
+                    for key in set(self.hits) | set(self.misses))